@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
-import sys
+import sys, time
 import anticloud
 
 result = True
+start = time.perf_counter()
+anticloud.start_plan()
 if not anticloud.merge_hardlink_all(*sys.argv[1:]):
     result = False
 if not anticloud.accumulate_all(*sys.argv[1:]):
     result = False
+anticloud.finish_command('auto', result, start)
 if result:
     print('all operations succeeded')
     exit(0)
@@ -1,5 +1,9 @@
 #!/usr/bin/env python3
-import os, sys, filecmp
+import os, re, sys, io, time, json, errno, heapq, fcntl, ctypes, select, struct, fnmatch, hashlib, sqlite3, threading, itertools, contextlib, collections, bisect, shutil
+import urllib.parse
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from stat import S_ISREG, S_ISLNK, S_IMODE
 
 # src and dst semantics
 # src is tree in which:
@@ -30,6 +34,42 @@ CONFIG_ACCUMULATE_SUBDIRS = ['DCIM']
 # fail: only files for which failed
 # fail_and_success: only files for which failed or succeeded (but not files for which nothing had to be done)
 CONFIG_LOG = 'fail_and_success'
+# default, chain: merge-hardlink-all merges any backup only with previous backup with same device-tag
+# all: merge-hardlink-all merges any backup with all later backups with same device-tag
+CONFIG_MERGE_ALL_MODE = os.getenv('ANTICLOUD_MERGE_ALL_MODE')
+# number of parallel jobs
+# merge-hardlink-all runs chains of backups with different device-tags in separate processes
+# merging of files within pair of backups and accumulating of files run in thread pool
+# default: 1 (no parallelism)
+CONFIG_JOBS = int(os.getenv('ANTICLOUD_JOBS') or 1)
+# default, touched: post check only re-stats files which were modified by run
+# full: post check walks whole trees
+CONFIG_VERIFY = os.getenv('ANTICLOUD_VERIFY')
+# buffer size for reading files for comparison and hashing, in bytes
+CONFIG_CMP_BUFSIZE = int(os.getenv('ANTICLOUD_CMP_BUFSIZE') or 4*1024*1024)
+# path to file to which metrics are appended as json lines
+# (event per merged pair of backups and per accumulated backup, summary per command)
+# default: no metrics file
+CONFIG_METRICS = os.getenv('ANTICLOUD_METRICS')
+# path to sqlite db with persistent state (file content hash cache, merged backup pairs, manifests of frozen backups)
+# default: .anticloud.sqlite in workdir for commands which take workdir, no db for others
+CONFIG_DB = os.getenv('ANTICLOUD_DB')
+# path to plan file to which readonly run writes modifying ops it skipped, as json lines, to be performed later by apply-plan
+# default: no plan file
+CONFIG_PLAN = os.getenv('ANTICLOUD_PLAN')
+# order in which merge-hardlink compares files, for disks on which seeks are expensive
+# default: scan order
+# inode: comparisons pending in window of files are ordered by inode number of src, which follows placement on disk on most filesystems
+# extent: comparisons pending in window of files are ordered by physical offset of first extent of src (FIEMAP), or by inode number if it is not available
+CONFIG_IO_ORDER = os.getenv('ANTICLOUD_IO_ORDER')
+# path to file with include/exclude rules for walking trees, see Rules
+# default: no rules (except default rules of accumulate)
+CONFIG_RULES = os.getenv('ANTICLOUD_RULES')
+# default: ingest hardlinks files with same size and mtime as in previous backup without reading them
+# hash: such files are only hardlinked if their contents hashes are equal
+CONFIG_INGEST_VERIFY = os.getenv('ANTICLOUD_INGEST_VERIFY')
+# seconds without changes in new backup after which watch considers it copied and processes it
+CONFIG_WATCH_SETTLE = float(os.getenv('ANTICLOUD_WATCH_SETTLE') or 60)
 
 # TODO like in df/du
 def size_human(size):
@@ -40,97 +80,1129 @@ def size_human(size):
         size /= 1024
     return '{:.1f}'.format(size)+['b', 'k', 'm', 'g', 't'][step]
 
-def merge_file(src, dst):
+DB_FILENAME = '.anticloud.sqlite'
+DB_SCHEMA = '''
+create table if not exists hashes (
+    dev integer not null,
+    ino integer not null,
+    size integer not null,
+    mtime_ns integer not null,
+    hash blob not null,
+    primary key (dev, ino)
+);
+create table if not exists manifest_dirs (
+    dir blob not null primary key,
+    parent blob not null,
+    dev integer not null,
+    mtime_ns integer not null
+);
+create index if not exists manifest_dirs_parent on manifest_dirs (parent);
+create table if not exists manifest_files (
+    dir blob not null,
+    name blob not null,
+    mode integer not null,
+    ino integer not null,
+    nlink integer not null,
+    size integer not null,
+    mtime_ns integer not null,
+    primary key (dir, name)
+);
+create table if not exists merged (
+    old_backup text not null,
+    new_backup text not null,
+    primary key (old_backup, new_backup)
+);
+create table if not exists index_dirs (
+    dir blob not null primary key,
+    parent blob not null,
+    dev integer not null,
+    mtime_ns integer not null
+);
+create index if not exists index_dirs_parent on index_dirs (parent);
+create table if not exists index_files (
+    dir blob not null,
+    name blob not null,
+    root blob not null,
+    dev integer not null,
+    ino integer not null,
+    nlink integer not null,
+    size integer not null,
+    primary key (dir, name)
+);
+create index if not exists index_files_size on index_files (size, dev, ino);
+create table if not exists checkpoints (
+    old_backup blob not null,
+    new_backup blob not null,
+    path blob not null,
+    primary key (old_backup, new_backup)
+);
+'''
+DB_TABLES = re.findall(r'create table if not exists (\w+)', DB_SCHEMA)
+# commit after this many writes, so that cache survives interrupted runs
+DB_COMMIT_INTERVAL = 1000
+
+db_path = CONFIG_DB
+db_conn = None
+# worker processes of merge-hardlink-all share db, so they commit every write
+# (write transaction left open while file is compared would lock db for other workers)
+db_commit_interval = DB_COMMIT_INTERVAL
+# readonly mode: db doesn't exist or can't be used
+db_missing = False
+db_pending = 0
+# connection is shared by threads of file jobs pool
+db_lock = threading.RLock()
+
+def open_db(path):
+    global db_path, db_conn, db_missing
+    if db_conn is not None:
+        db_close()
+    db_path = path
+    db_missing = False
+
+# open db for workdir unless db path is explicitly configured
+def open_workdir_db(workdir):
+    if db_path is None:
+        open_db(os.path.join(workdir, DB_FILENAME))
+    recover_journals()
+
+def get_db():
+    global db_conn, db_missing
+    if db_path is None or db_missing:
+        return None
+    with db_lock:
+        if db_conn is None and CONFIG_READONLY:
+            db_conn = connect_db_readonly()
+            if db_conn is None:
+                db_missing = True
+                return None
+        if db_conn is None:
+            db_conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+            # allow concurrent readers in parallel processes
+            db_conn.execute('pragma journal_mode=wal')
+            db_conn.executescript(DB_SCHEMA)
+    return db_conn
+
+# readonly mode: db is not created and is only read (so that dry run works on read-only mount),
+# db which doesn't exist or doesn't have all tables is not used
+# (callers which write check CONFIG_READONLY)
+def connect_db_readonly():
+    if not os.path.exists(db_path):
+        return None
+    try:
+        conn = sqlite3.connect('file:{0}?mode=ro'.format(urllib.parse.quote(os.path.abspath(db_path))), uri=True, timeout=60, check_same_thread=False)
+        tables = set(name for name, in conn.execute('select name from sqlite_master where type=\'table\''))
+    except sqlite3.Error as e:
+        print('can\'t open db, not using it:', db_path, e)
+        return None
+    if not set(DB_TABLES) <= tables:
+        conn.close()
+        return None
+    return conn
+
+def db_read(sql, params=()):
+    with db_lock:
+        return get_db().execute(sql, params).fetchone()
+
+def db_query(sql, params=()):
+    with db_lock:
+        return get_db().execute(sql, params).fetchall()
+
+# like db_query, but rows are fetched in batches as they are consumed
+def db_iter(sql, params=()):
+    with db_lock:
+        cursor = get_db().execute(sql, params)
+    while True:
+        with db_lock:
+            rows = cursor.fetchmany(DB_COMMIT_INTERVAL)
+        if not rows:
+            return
+        yield from rows
+
+def db_write(sql, params=()):
+    global db_pending
+    with db_lock:
+        get_db().execute(sql, params)
+        db_pending += 1
+        if db_pending >= db_commit_interval:
+            db_commit()
+
+def db_commit():
+    global db_pending
+    with db_lock:
+        if db_conn is not None:
+            db_conn.commit()
+        db_pending = 0
+
+def db_close():
+    global db_conn
+    journal_close()
+    if db_conn is not None:
+        db_commit()
+        db_conn.close()
+        db_conn = None
+
+# write-ahead journal of link ops, so that files left by interrupted run can be removed by next run
+# dst is replaced by linking src to tmp path next to dst and renaming it over dst, so only tmp file can be left
+# journal is kept next to db, one per process, tmp paths are appended to it before linking
+# journal is locked (flock) by its process while it exists, so that only journals of processes which are gone are recovered
+# dirs of linked files and journal are fsynced in batches, then journal is truncated to ops which are still in progress
+JOURNAL_FILENAME = '.anticloud-journal'
+HARDLINK_TMP_SUFFIX = '-anticloud-hardlink-tmp'
+# number of files after which merge-hardlink fsyncs journal and records checkpoint
+# (also window of files within which comparisons are ordered by CONFIG_IO_ORDER)
+JOURNAL_BATCH = 1000
+
+journal_lock = threading.Lock()
+journal_file = None
+# dirs in which links were created since last fsync
+journal_dirs = set()
+# tmp path -> dst of ops in progress
+journal_inflight = {}
+journal_recovered = False
+
+def journal_dir():
+    return os.path.dirname(os.path.abspath(db_path))
+
+def journal_link(tmp, dst):
+    global journal_file
+    if db_path is None:
+        return
+    with journal_lock:
+        if journal_file is None:
+            journal_file = journal_open()
+        journal_inflight[tmp] = dst
+        journal_dirs.add(os.path.dirname(dst))
+        # flushed to os, so that it survives crash of process
+        journal_file.write(json.dumps({'tmp': tmp, 'dst': dst})+'\n')
+        journal_file.flush()
+
+def journal_open():
+    path = os.path.join(journal_dir(), '{0}-{1}'.format(JOURNAL_FILENAME, os.getpid()))
+    while True:
+        f = open(path, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        # journal left by process with same pid could be removed by recover_journals between open and lock
+        if journal_is_linked(f, path):
+            return f
+        f.close()
+
+def journal_is_linked(f, path):
+    try:
+        return os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+    except FileNotFoundError:
+        return False
+
+def journal_done(tmp):
+    with journal_lock:
+        journal_inflight.pop(tmp, None)
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def journal_sync():
+    if journal_file is None:
+        return
+    with journal_lock:
+        with phase('fsync'):
+            for dirpath in journal_dirs:
+                fsync_dir(dirpath)
+            journal_dirs.clear()
+            journal_file.truncate(0)
+            for tmp, dst in journal_inflight.items():
+                journal_file.write(json.dumps({'tmp': tmp, 'dst': dst})+'\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+def journal_close():
+    global journal_file
+    if journal_file is None:
+        return
+    journal_sync()
+    # removed while it is locked
+    os.unlink(journal_file.name)
+    journal_file.close()
+    journal_file = None
+
+# remove tmp files of ops which were in progress when previous run was interrupted
+# dst of such op is untouched, so op is rolled back and is done again when its pair of backups is resumed
+def recover_journals():
+    global journal_recovered
+    if journal_recovered or db_path is None or CONFIG_READONLY:
+        return
+    journal_recovered = True
+    for name in os.listdir(journal_dir()):
+        if not name.startswith(JOURNAL_FILENAME+'-'):
+            continue
+        path = os.path.join(journal_dir(), name)
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            continue
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # journal of running process
+                continue
+            # removed by its process before it was locked here
+            if not journal_is_linked(f, path):
+                continue
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    # last line can be incomplete
+                    continue
+                if os.path.lexists(op['tmp']):
+                    print('removing tmp file left by interrupted run:', op['tmp'])
+                    os.unlink(op['tmp'])
+            os.unlink(path)
+
+# last file of old backup up to which merge-hardlink of pair of backups was done by interrupted run
+def get_checkpoint(old_backup_root, new_backup_root):
+    if get_db() is None:
+        return None
+    row = db_read('select path from checkpoints where old_backup=? and new_backup=?', (manifest_dir_key(old_backup_root), manifest_dir_key(new_backup_root)))
+    return os.path.join(old_backup_root, os.fsdecode(row[0])) if row else None
+
+# links before checkpoint are made durable before checkpoint is recorded
+def set_checkpoint(old_backup_root, new_backup_root, filepath):
+    if get_db() is None or CONFIG_READONLY:
+        return
+    journal_sync()
+    db_write('insert or replace into checkpoints (old_backup, new_backup, path) values (?, ?, ?)',
+             (manifest_dir_key(old_backup_root), manifest_dir_key(new_backup_root), os.fsencode(os.path.relpath(filepath, old_backup_root))))
+    db_commit()
+
+def delete_checkpoint(old_backup_root, new_backup_root):
+    if get_db() is None or CONFIG_READONLY:
+        return
+    db_write('delete from checkpoints where old_backup=? and new_backup=?', (manifest_dir_key(old_backup_root), manifest_dir_key(new_backup_root)))
+
+# counters of work done, for reporting
+# Counter is not thread safe, so counters are updated under lock
+# seconds_* counters are time spent in phases (walk, compare, link, verify), summed over threads
+counters = collections.Counter()
+counters_lock = threading.Lock()
+# (seconds, src, dst) of slowest file comparisons
+slowest_files = []
+SLOWEST_FILES_COUNT = 10
+
+def count(name, n=1):
+    with counters_lock:
+        counters[name] += n
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        count('seconds_'+name, time.perf_counter()-start)
+
+def record_slow_file(seconds, src, dst):
+    with counters_lock:
+        if len(slowest_files) < SLOWEST_FILES_COUNT:
+            heapq.heappush(slowest_files, (seconds, src, dst))
+        elif seconds > slowest_files[0][0]:
+            heapq.heapreplace(slowest_files, (seconds, src, dst))
+
+# merge counters and slowest files of worker process
+def merge_metrics(counters_, slowest_files_):
+    counters.update(counters_)
+    for seconds, src, dst in slowest_files_:
+        record_slow_file(seconds, src, dst)
+
+def print_counters():
+    if counters['files_scanned'] or counters['files_from_manifest']:
+        print('scanned files: {0}, from manifests: {1}, stat calls: {2}'.format(counters['files_scanned'], counters['files_from_manifest'], counters['stat_calls']))
+    if counters['cmp_files']:
+        print('compared files: {0}, bytes read: {1} of {2} (+{3} sampled), rejected by samples: {4}, decided by cached hashes: {5}'.format(
+            counters['cmp_files'], size_human(counters['cmp_bytes_read']), size_human(counters['cmp_bytes_total']), size_human(counters['cmp_bytes_sampled']),
+            counters['cmp_rejected_by_samples'], counters['cmp_cached']))
+    if counters['links_created']:
+        print('hardlinks created: {0}, space saved: {1}'.format(counters['links_created'], size_human(counters['link_bytes_saved'])))
+    seconds = ['{0}: {1:.1f}s'.format(name[len('seconds_'):], counters[name]) for name in sorted(counters) if name.startswith('seconds_')]
+    if seconds:
+        print('time in phases:', ', '.join(seconds))
+
+# append json line to metrics file
+def emit_metrics(event, **fields):
+    if not CONFIG_METRICS:
+        return
+    line = json.dumps(dict(event=event, time=time.time(), pid=os.getpid(), **fields))+'\n'
+    # single write in append mode, so that lines of parallel processes don't mix
+    with open(CONFIG_METRICS, 'a') as f:
+        f.write(line)
+
+def counters_delta(before):
+    return {name: val-before.get(name, 0) for name, val in counters.items() if val != before.get(name, 0)}
+
+# common ending of commands, called by main and by anticloud-auto
+def finish_command(name, result, start):
+    db_close()
+    print_counters()
+    emit_metrics('summary', command=name, result=result, seconds=time.perf_counter()-start, counters=dict(counters),
+                 slowest_files=[{'seconds': seconds, 'src': src, 'dst': dst} for seconds, src, dst in sorted(slowest_files, reverse=True)])
+
+# file content reading
+# files are read with large buffer, page cache is advised to read ahead and to drop pages which were read
+# (so that comparing multi-GB videos doesn't evict everything else from page cache)
+CMP_SAMPLE_BLOCKSIZE = 4096
+# number of blocks sampled between first and last block
+CMP_SAMPLE_BLOCKS = 6
+# smaller files are not sampled, because samples of file which is equal are read again when it is read in full,
+# and for small files that costs more than it saves on files which differ
+CMP_SAMPLE_MIN_SIZE = 4*1024*1024
+
+def fadvise(fd, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+# FS_IOC_FIEMAP ioctl, struct fiemap header is followed by array of struct fiemap_extent
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER = struct.Struct('=QQIIII')
+FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+
+# physical offset of first extent of file, or None if it is not known
+def file_physical_offset(path):
+    buf = bytearray(FIEMAP_HEADER.pack(0, 2**64-1, 0, 0, 1, 0)+bytes(FIEMAP_EXTENT.size))
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buf)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    if not FIEMAP_HEADER.unpack_from(buf)[3]:
+        return None
+    return FIEMAP_EXTENT.unpack_from(buf, FIEMAP_HEADER.size)[1]
+
+# ask kernel to start reading beginning of file into page cache, so that it is read while other files are compared
+def prefetch(path, length):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    fadvise(fd, 0, length, getattr(os, 'POSIX_FADV_WILLNEED', 0))
+    os.close(fd)
+
+# path relative to dir_fd if it is given, so that kernel only has to resolve last component
+def at(path, dir_fd):
+    return path if dir_fd is None else os.path.basename(path)
+
+def open_for_reading(path, dir_fd=None):
+    fd = os.open(at(path, dir_fd), os.O_RDONLY, dir_fd=dir_fd)
+    fadvise(fd, 0, 0, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+    return fd
+
+# read file from start in chunks of CONFIG_CMP_BUFSIZE, yielding memoryview of buffer which is reused
+def read_chunks(fd, buf):
+    f = open(fd, 'rb', buffering=0, closefd=False)
+    offset = 0
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        count('cmp_bytes_read', n)
+        yield memoryview(buf)[:n]
+        fadvise(fd, offset, n, getattr(os, 'POSIX_FADV_DONTNEED', 0))
+        offset += n
+
+# offsets of first, last and evenly spaced blocks between them
+def sample_offsets(size):
+    last = size-CMP_SAMPLE_BLOCKSIZE
+    step = last//(CMP_SAMPLE_BLOCKS+1)
+    return sorted(set([0, last]+[step*i//CMP_SAMPLE_BLOCKSIZE*CMP_SAMPLE_BLOCKSIZE for i in range(1, CMP_SAMPLE_BLOCKS+1)]))
+
+# for files of at least CMP_SAMPLE_MIN_SIZE
+# sampled bytes are counted separately from cmp_bytes_read, because they are read again if samples are equal
+def samples_equal(src_fd, dst_fd, size):
+    for offset in sample_offsets(size):
+        src_block = os.pread(src_fd, CMP_SAMPLE_BLOCKSIZE, offset)
+        dst_block = os.pread(dst_fd, len(src_block), offset)
+        count('cmp_bytes_sampled', len(src_block)+len(dst_block))
+        if src_block != dst_block:
+            return False
+    return True
+
+# file content hash cache
+# keyed by (st_dev, st_ino, st_size, st_mtime_ns), so that hash is recalculated if file is replaced or modified
+# (modification without mtime change is not detected, same as with rsync and make)
+HASH_BUFSIZE = 1024*1024
+
+def hash_cache_get(stat):
+    if get_db() is None:
+        return None
+    row = db_read('select hash from hashes where dev=? and ino=? and size=? and mtime_ns=?',
+                  (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+    return row[0] if row else None
+
+def hash_cache_put(stat, hash_):
+    if get_db() is None or CONFIG_READONLY:
+        return
+    db_write('insert or replace into hashes (dev, ino, size, mtime_ns, hash) values (?, ?, ?, ?, ?)',
+             (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, hash_))
+
+# pairs of backups which were successfully merged by merge-hardlink-all
+def is_merged(old_backup, new_backup):
+    if get_db() is None:
+        return False
+    return db_read('select 1 from merged where old_backup=? and new_backup=?', (old_backup, new_backup)) is not None
+
+def set_merged(old_backup, new_backup):
+    if get_db() is None or CONFIG_READONLY:
+        return
+    db_write('insert or ignore into merged (old_backup, new_backup) values (?, ?)', (old_backup, new_backup))
+    db_commit()
+
+def file_hash(path, stat=None, dir_fd=None):
+    if stat is None:
+        stat = os.stat(at(path, dir_fd), dir_fd=dir_fd, follow_symlinks=False)
+    hash_ = hash_cache_get(stat)
+    if hash_ is not None:
+        return hash_
+    hasher = hashlib.blake2b(digest_size=32)
+    fd = open_for_reading(path, dir_fd)
+    try:
+        for chunk in read_chunks(fd, bytearray(CONFIG_CMP_BUFSIZE)):
+            hasher.update(chunk)
+    finally:
+        os.close(fd)
+    hash_ = hasher.digest()
+    hash_cache_put(stat, hash_)
+    return hash_
+
+def files_equal(src, dst, src_stat=None, dst_stat=None, src_dir_fd=None, dst_dir_fd=None):
+    start = time.perf_counter()
+    try:
+        return compare_files(src, dst, src_stat, dst_stat, src_dir_fd, dst_dir_fd)
+    finally:
+        seconds = time.perf_counter()-start
+        count('seconds_compare', seconds)
+        record_slow_file(seconds, src, dst)
+
+# compare file contents
+# decided by cached hashes if both are known, else sampled blocks of large files are compared first for fast reject of files which differ,
+# then rest is read in full (only file with unknown hash if other hash is known)
+# hashes calculated while reading are stored in cache if db is available
+def compare_files(src, dst, src_stat=None, dst_stat=None, src_dir_fd=None, dst_dir_fd=None):
+    if src_stat is None:
+        src_stat = os.stat(at(src, src_dir_fd), dir_fd=src_dir_fd, follow_symlinks=False)
+    if dst_stat is None:
+        dst_stat = os.stat(at(dst, dst_dir_fd), dir_fd=dst_dir_fd, follow_symlinks=False)
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    count('cmp_files')
+    count('cmp_bytes_total', src_stat.st_size*2)
+    src_hash = hash_cache_get(src_stat)
+    dst_hash = hash_cache_get(dst_stat)
+    if src_hash is not None and dst_hash is not None:
+        count('cmp_cached')
+        return src_hash == dst_hash
+    src_fd = open_for_reading(src, src_dir_fd)
+    try:
+        dst_fd = open_for_reading(dst, dst_dir_fd)
+        try:
+            hasher = hashlib.blake2b(digest_size=32) if get_db() is not None else None
+            # small files are read in full as single sample
+            if src_stat.st_size <= 2*CMP_SAMPLE_BLOCKSIZE:
+                src_data = os.pread(src_fd, 2*CMP_SAMPLE_BLOCKSIZE+1, 0)
+                dst_data = os.pread(dst_fd, 2*CMP_SAMPLE_BLOCKSIZE+1, 0)
+                count('cmp_bytes_read', len(src_data)+len(dst_data))
+                if src_data != dst_data:
+                    return False
+                if hasher is not None:
+                    hasher.update(src_data)
+            else:
+                if src_stat.st_size >= CMP_SAMPLE_MIN_SIZE and not samples_equal(src_fd, dst_fd, src_stat.st_size):
+                    count('cmp_rejected_by_samples')
+                    return False
+                if src_hash is not None or dst_hash is not None:
+                    return file_hash(src, src_stat, src_dir_fd) == file_hash(dst, dst_stat, dst_dir_fd)
+                dst_chunks = read_chunks(dst_fd, bytearray(CONFIG_CMP_BUFSIZE))
+                for src_chunk in read_chunks(src_fd, bytearray(CONFIG_CMP_BUFSIZE)):
+                    if src_chunk != next(dst_chunks, None):
+                        return False
+                    if hasher is not None:
+                        hasher.update(src_chunk)
+                if next(dst_chunks, None) is not None:
+                    return False
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    if hasher is not None:
+        hash_ = hasher.digest()
+        hash_cache_put(src_stat, hash_)
+        hash_cache_put(dst_stat, hash_)
+    return True
+
+# paths modified by merge_file, for post check
+touched_paths = set()
+
+# plan of modifying ops skipped in readonly mode
+# every op has fingerprints of files it relies on, so that apply-plan only has to re-stat files instead of comparing them again
+plan_lock = threading.Lock()
+
+def file_fingerprint(stat):
+    return [stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+# abspath -> (fingerprint, hardlink count) which file will have once planned ops are applied
+# (e.g. in chain of backups, file of middle backup is planned to be replaced by hardlink before it is src of next pair)
+planned_files = {}
+
+# fingerprint and hardlink count of file as expected by ops planned after ops which were already planned
+def planned_fingerprint(path, stat):
+    with plan_lock:
+        if planned_files:
+            planned = planned_files.get(os.path.abspath(path))
+            if planned is not None:
+                return planned
+    return file_fingerprint(stat), stat.st_nlink
+
+def set_planned_fingerprint(path, fingerprint, nlink):
+    with plan_lock:
+        planned_files[os.path.abspath(path)] = fingerprint, nlink
+
+# called by main and by anticloud-auto, so that plan only has ops of last run
+def start_plan():
+    if CONFIG_READONLY and CONFIG_PLAN:
+        open(CONFIG_PLAN, 'w').close()
+
+def plan_op(op, **fields):
+    if not (CONFIG_READONLY and CONFIG_PLAN):
+        return
+    line = json.dumps(dict(op=op, **fields))+'\n'
+    # plan is appended to by threads and by worker processes, so every op is single write in append mode
+    with plan_lock, open(CONFIG_PLAN, 'a') as f:
+        f.write(line)
+
+# replace dst with hardlink to src
+# hardlink is created at tmp path and renamed over dst, so dst is replaced atomically
+def replace_with_hardlink(src, dst, src_dir_fd=None, dst_dir_fd=None):
+    tmp = dst+HARDLINK_TMP_SUFFIX
+    with phase('link'):
+        journal_link(tmp, dst)
+        try:
+            os.link(at(src, src_dir_fd), at(tmp, dst_dir_fd), src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+        except FileExistsError:
+            # left by interrupted run whose journal entry didn't survive
+            os.unlink(at(tmp, dst_dir_fd), dir_fd=dst_dir_fd)
+            os.link(at(src, src_dir_fd), at(tmp, dst_dir_fd), src_dir_fd=src_dir_fd, dst_dir_fd=dst_dir_fd)
+        os.rename(at(tmp, dst_dir_fd), at(dst, dst_dir_fd), src_dir_fd=dst_dir_fd, dst_dir_fd=dst_dir_fd)
+        journal_done(tmp)
+
+# checks which only need st_dev, st_ino and st_size
+# return None if same file, False if can't merge, True if can continue
+def check_merge_stats(src_stat, dst_stat):
+    if src_stat.st_dev != dst_stat.st_dev:
+        print_to_msg_buf(' different filesystems, can\'t merge')
+        return False
+    if src_stat.st_ino == dst_stat.st_ino:
+        print_to_msg_buf(' same file (already hardlinked)')
+        return None
+    if src_stat.st_size != dst_stat.st_size:
+        print_to_msg_buf(' different size, can\'t merge')
+        print_to_msg_buf('', src_stat.st_size, dst_stat.st_size)
+        return False
+    return True
+
+# same checks as check_merge_stats, without messages
+def check_merge_stats_quiet(src_stat, dst_stat):
+    if src_stat.st_dev != dst_stat.st_dev:
+        return False
+    if src_stat.st_ino == dst_stat.st_ino:
+        return None
+    return src_stat.st_size == dst_stat.st_size
+
+# src_stat and dst_stat: stats collected by tree scan, if available
+# they are only used to skip files which are already hardlinked or differ, and are refreshed before further checks
+# src_dir_fd and dst_dir_fd: fds of dirs of src and dst, if open, so that files are accessed relative to them
+def merge_file(src, dst, src_stat=None, dst_stat=None, src_dir_fd=None, dst_dir_fd=None):
     print_to_msg_buf(" merging src and dst:", src, dst)
     # assume that both src and dst exist
     # outer code should check it and if not do accordingly (skip if merging backups or create hardlink if accumulating)
     #if not os.path.exists(src):
     #    print_to_msg_buf(' src does not exist')
     #    return
-    if os.stat(src, follow_symlinks=False).st_dev != os.stat(dst, follow_symlinks=False).st_dev:
-        print_to_msg_buf(' different filesystems, can\'t merge')
-        return False
-    if os.path.samefile(src, dst):
-        print_to_msg_buf(' same file (already hardlinked)')
-        return
-    if os.path.getsize(src) != os.path.getsize(dst):
-        print_to_msg_buf(' different size, can\'t merge')
-        print_to_msg_buf('', os.path.getsize(src), os.path.getsize(dst))
-        return False
-    if os.stat(dst, follow_symlinks=False).st_nlink>1 and not CONFIG_DST_HARDLINK_COUNT_MULTIPLE=='force':
-        if os.stat(src, follow_symlinks=False).st_nlink>1:
+    if src_stat is not None and dst_stat is not None:
+        res = check_merge_stats(src_stat, dst_stat)
+        if res is not True:
+            return res
+    src_stat = os.stat(at(src, src_dir_fd), dir_fd=src_dir_fd, follow_symlinks=False)
+    dst_stat = os.stat(at(dst, dst_dir_fd), dir_fd=dst_dir_fd, follow_symlinks=False)
+    count('stat_calls', 2)
+    res = check_merge_stats(src_stat, dst_stat)
+    if res is not True:
+        return res
+    # src fingerprint expected by planned link, changes if utime of src is planned before it
+    src_fingerprint, src_nlink = planned_fingerprint(src, src_stat)
+    if dst_stat.st_nlink>1 and not CONFIG_DST_HARDLINK_COUNT_MULTIPLE=='force':
+        if src_stat.st_nlink>1:
             print_to_msg_buf(' src and dst have hardlink count >1, CONFIG_DST_HARDLINK_COUNT_MULTIPLE is not \'force\', can\'t merge')
+            count('files_refused_by_config')
             return False
         if CONFIG_DST_HARDLINK_COUNT_MULTIPLE == 'swap':
             print_to_msg_buf(' src has hardlink count 1, dst has hardlink count >1, swapping')
             src, dst = dst, src
+            src_stat, dst_stat = dst_stat, src_stat
+            src_dir_fd, dst_dir_fd = dst_dir_fd, src_dir_fd
+            src_fingerprint, src_nlink = planned_fingerprint(src, src_stat)
         else:
             print_to_msg_buf(' src has hardlink count 1, dst has hardlink count >1, CONFIG_DST_HARDLINK_COUNT_MULTIPLE is not \'force\' or \'swap\', can\'t merge')
+            count('files_refused_by_config')
             return False
     # older mtime is not if
     # - 1970-01-01
     # - has zero time part
     # - is equal to exif time
-    if os.path.getmtime(src) > os.path.getmtime(dst) and not CONFIG_DST_MTIME_OLDER=='force':
+    if src_stat.st_mtime_ns > dst_stat.st_mtime_ns and not CONFIG_DST_MTIME_OLDER=='force':
         if CONFIG_DST_MTIME_OLDER != 'setonsrc':
             print_to_msg_buf(' dst has older mtime, CONFIG_DST_MTIME_OLDER is not \'force\' or \'setonsrc\', can\'t merge')
+            count('files_refused_by_config')
             return False
         print_to_msg_buf(' dst has older mtime, setting on src')
         if not CONFIG_READONLY:
-            os.utime(src, (os.stat(src, follow_symlinks=False).st_atime, os.stat(dst, follow_symlinks=False).st_mtime))
+            os.utime(at(src, src_dir_fd), ns=(src_stat.st_atime_ns, dst_stat.st_mtime_ns), dir_fd=src_dir_fd)
+            touched_paths.add(src)
+            src_stat = os.stat(at(src, src_dir_fd), dir_fd=src_dir_fd, follow_symlinks=False)
         else:
             print_to_msg_buf(' readonly mode, skipping modifying op')
-    if not filecmp.cmp(src, dst):
+            plan_op('utime', path=os.path.abspath(src), fingerprint=src_fingerprint, mtime_ns=dst_stat.st_mtime_ns)
+            src_fingerprint = src_fingerprint[:3]+[dst_stat.st_mtime_ns]
+            set_planned_fingerprint(src, src_fingerprint, src_nlink)
+    if not files_equal(src, dst, src_stat, dst_stat, src_dir_fd, dst_dir_fd):
         print_to_msg_buf(' different contents, can\'t merge')
         return False
     print_to_msg_buf(' hardlinking files')
     if not CONFIG_READONLY:
-        # TODO
-        os.rename(dst, dst+'-anticloud-hardlink-bak')
-        os.link(src, dst)
-        os.unlink(dst+'-anticloud-hardlink-bak')
+        replace_with_hardlink(src, dst, src_dir_fd, dst_dir_fd)
+        touched_paths.add(dst)
+        count('links_created')
+        # space is only freed if dst inode has no other hardlinks
+        if dst_stat.st_nlink == 1:
+            count('link_bytes_saved', dst_stat.st_size)
     else:
         print_to_msg_buf(' readonly mode, skipping modifying op')
+        dst_fingerprint, dst_nlink = planned_fingerprint(dst, dst_stat)
+        plan_op('link', src=os.path.abspath(src), dst=os.path.abspath(dst), src_fingerprint=src_fingerprint,
+                dst_fingerprint=dst_fingerprint, dst_nlink=dst_nlink)
+        set_planned_fingerprint(src, src_fingerprint, src_nlink+1)
+        set_planned_fingerprint(dst, src_fingerprint, src_nlink+1)
     return True
 
-def get_filepath_data_for_filedict(filepath):
-    return {'stat': os.stat(filepath, follow_symlinks=False)}
+# include/exclude rules for files and dirs of walked trees
+# rules file has rule per line, rules before first [command] section apply to all commands:
+#   exclude PATTERN, include PATTERN: glob, matched against name if it has no /, else against path relative to walked root
+#     (leading / is ignored, trailing / restricts pattern to dirs)
+#   exclude-re REGEX, include-re REGEX: regex, searched in path relative to walked root
+#   min-size SIZE, max-size SIZE: files with size out of range are excluded (size can have k, m, g, t suffix)
+# first matching pattern decides, files and dirs which no pattern matches are included
+# excluded dirs are pruned before they are opened, excluded files are skipped before they are stat'ed (unless size rules are given)
+# sections are named after commands which walk trees: merge-hardlink (also used by merge-hardlink-all, watch), accumulate,
+# dedup-global, show-size, space-report, verify, clone-hardlink, ingest (applied to source tree)
+# rules of section are applied before rules for all commands, which are applied before default rules
+RULES_DEFAULT = {
+    # hidden files and dirs and json metadata are not accumulated
+    'accumulate': ['exclude .*', 'exclude *.json'],
+}
+
+def parse_size(str_):
+    str_ = str_.lower()
+    if str_ and str_[-1] in 'kmgt':
+        return int(str_[:-1])*1024**('kmgt'.index(str_[-1])+1)
+    return int(str_)
+
+class Rules:
+    def __init__(self, lines):
+        # (include, match function, match name only, dirs only)
+        self.patterns = []
+        self.min_size = None
+        self.max_size = None
+        for line in lines:
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise ValueError('bad rule: '+line)
+            action, arg = parts
+            if action in ('include', 'exclude'):
+                dirs_only = arg.endswith('/')
+                arg = arg.strip('/')
+                self.patterns.append((action == 'include', re.compile(fnmatch.translate(arg)).match, '/' not in arg, dirs_only))
+            elif action in ('include-re', 'exclude-re'):
+                self.patterns.append((action == 'include-re', re.compile(arg).search, False, False))
+            elif action == 'min-size':
+                self.min_size = parse_size(arg)
+            elif action == 'max-size':
+                self.max_size = parse_size(arg)
+            else:
+                raise ValueError('unknown rule: '+line)
+
+    def excludes_path(self, relpath, is_dir):
+        name = relpath.rsplit('/', 1)[-1]
+        for include, match, match_name, dirs_only in self.patterns:
+            if dirs_only and not is_dir:
+                continue
+            if match(name if match_name else relpath):
+                return not include
+        return False
+
+    def excludes_size(self, size):
+        return (self.min_size is not None and size < self.min_size) or (self.max_size is not None and size > self.max_size)
+
+    def has_size_rules(self):
+        return self.min_size is not None or self.max_size is not None
+
+    # for walkers which only stat files if needed
+    def excludes_entry(self, relpath, entry):
+        is_dir = entry.is_dir(follow_symlinks=False)
+        if self.excludes_path(relpath, is_dir):
+            return True
+        return not is_dir and self.has_size_rules() and self.excludes_size(entry.stat(follow_symlinks=False).st_size)
+
+# section -> rule lines, loaded once
+rules_sections = None
+# section -> Rules or None, compiled once
+rules_cache = {}
+
+def get_rules(section):
+    global rules_sections
+    if rules_sections is None:
+        rules_sections = {}
+        if CONFIG_RULES:
+            lines = rules_sections[None] = []
+            for line in open(CONFIG_RULES):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if line.startswith('[') and line.endswith(']'):
+                    lines = rules_sections.setdefault(line[1:-1], [])
+                    continue
+                lines.append(line)
+    if section not in rules_cache:
+        lines = rules_sections.get(section, [])+rules_sections.get(None, [])+RULES_DEFAULT.get(section, [])
+        rules_cache[section] = Rules(lines) if lines else None
+    return rules_cache[section]
+
+# path of entry relative to walked root, as matched by rules
+def rules_relpath(rel_dir, name):
+    return rel_dir+'/'+name if rel_dir else name
+
+# walk tree like os.walk, but with os.scandir, yielding (dirpath, [(name, stat), ...], dir_stat, from_manifest) for each dir
+# stat is taken once per file (and is not taken for dirs at all unless use_manifest)
+# use_manifest: if db is available, dirs are stat'ed and files of dirs which are unchanged since they were recorded in manifest are taken from it
+# rules: files and dirs excluded by them are skipped, dirs from which anything was skipped are yielded without dir_stat (so they are not recorded in manifest)
+# dirs and files are yielded in sorted order
+# dirs are opened relative to fd of parent dir and listed and stat'ed via their fds, so that paths are not resolved again for every file
+def scan_tree_dirs(root, use_manifest=False, rules=None):
+    use_manifest = use_manifest and get_db() is not None
+    try:
+        fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return
+    yield from scan_dir_fd(root, '', fd, use_manifest, rules)
+
+# rel_dir: path of dir relative to root, for rules
+# fd is closed when dir and its subdirs are done
+def scan_dir_fd(dirpath, rel_dir, fd, use_manifest, rules):
+    try:
+        # same as os.walk: dirs which can't be listed are skipped
+        try:
+            files, subdirs, dir_stat, from_manifest = list_dir_fd(dirpath, rel_dir, fd, use_manifest, rules)
+        except OSError:
+            return
+        yield dirpath, files, dir_stat, from_manifest
+        for name in subdirs:
+            try:
+                subdir_fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=fd)
+            except OSError:
+                continue
+            yield from scan_dir_fd(os.path.join(dirpath, name), rules_relpath(rel_dir, name), subdir_fd, use_manifest, rules)
+    finally:
+        os.close(fd)
+
+# ([(name, stat), ...], [subdir name, ...], dir_stat, from_manifest) of dir
+def list_dir_fd(dirpath, rel_dir, fd, use_manifest, rules):
+    dir_stat = None
+    if use_manifest:
+        dir_stat = os.stat(fd)
+        count('stat_calls')
+        manifest = manifest_get_dir(dirpath, dir_stat)
+        if manifest is not None:
+            files, subdirs = manifest
+            count('files_from_manifest', len(files))
+            if rules is not None:
+                files = [(name, stat) for name, stat in files
+                         if not rules.excludes_path(rules_relpath(rel_dir, name), False) and not rules.excludes_size(stat.st_size)]
+                subdirs = [name for name in subdirs if not rules.excludes_path(rules_relpath(rel_dir, name), True)]
+            return files, subdirs, dir_stat, True
+    with os.scandir(fd) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    subdirs = []
+    files = []
+    excluded = 0
+    for entry in entries:
+        if rules is not None and rules.excludes_entry(rules_relpath(rel_dir, entry.name), entry):
+            excluded += 1
+            continue
+        # same as os.walk: symlinks to dirs are neither files nor followed
+        if entry.is_dir():
+            if not entry.is_symlink():
+                subdirs.append(entry.name)
+            continue
+        # scandir of fd stats entries relative to it
+        files.append((entry.name, entry.stat(follow_symlinks=False)))
+    count('files_scanned', len(files))
+    count('stat_calls', len(files))
+    if excluded:
+        count('entries_excluded', excluded)
+        dir_stat = None
+    return files, subdirs, dir_stat, False
+
+# yield (filepath, stat) for files in tree
+def scan_tree(root, rules=None):
+    for dirpath, files, dir_stat, from_manifest in scan_tree_dirs(root, rules=rules):
+        for name, stat in files:
+            yield os.path.join(dirpath, name), stat
+
+# subset of os.stat_result fields which is stored in FileTable
+FileStat = collections.namedtuple('FileStat', ['st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_size', 'st_mtime_ns'])
+
+# compact replacement for dict of filepath -> stat, for trees with millions of files
+# fields are stored in array columns, names in single bytes blob, dir paths once per dir
+# rows of each dir are contiguous and sorted by name, so that lookup is bisect within dir
+# supports dict operations which are needed for merging and post check (get, in, del, items, len)
+class FileTable:
+    def __init__(self):
+        self.dirs = []
+        self.dir_index = {}
+        self.dir_dev = array('Q')
+        # 0 if not known
+        self.dir_mtime_ns = array('q')
+        self.dir_from_manifest = bytearray()
+        self.scan_start_ns = time.time_ns()
+        # rows of dir i are dir_start[i]..dir_start[i+1]
+        self.dir_start = array('Q')
+        self.names = bytearray()
+        self.name_end = array('Q')
+        self.mode = array('H')
+        self.ino = array('Q')
+        self.nlink = array('I')
+        self.size = array('Q')
+        self.mtime_ns = array('q')
+        # rows deleted by del, allocated on first del
+        self.deleted = None
+        self.count_deleted = 0
+        # rules with which tree was scanned
+        self.rules = None
+
+    def add_dir(self, dirpath, files, dir_stat=None, from_manifest=False):
+        # normalized same as os.path.dirname of file paths
+        dirpath = os.path.dirname(os.path.join(dirpath, '_'))
+        self.dir_index[dirpath] = len(self.dirs)
+        self.dirs.append(dirpath)
+        self.dir_dev.append(dir_stat.st_dev if dir_stat else files[0][1].st_dev if files else 0)
+        self.dir_mtime_ns.append(dir_stat.st_mtime_ns if dir_stat else 0)
+        self.dir_from_manifest.append(from_manifest)
+        self.dir_start.append(len(self.ino))
+        for name, stat in files:
+            self.names += os.fsencode(name)
+            self.name_end.append(len(self.names))
+            self.mode.append(stat.st_mode)
+            self.ino.append(stat.st_ino)
+            self.nlink.append(stat.st_nlink)
+            self.size.append(stat.st_size)
+            self.mtime_ns.append(stat.st_mtime_ns)
+
+    def dir_rows(self, dir_):
+        return range(self.dir_start[dir_], self.dir_start[dir_+1] if dir_+1 < len(self.dirs) else len(self.ino))
+
+    def row_name(self, row):
+        return os.fsdecode(bytes(self.names[self.name_end[row-1] if row else 0:self.name_end[row]]))
+
+    def row_stat(self, row, dir_):
+        return FileStat(self.mode[row], self.ino[row], self.dir_dev[dir_], self.nlink[row], self.size[row], self.mtime_ns[row])
+
+    def find(self, filepath):
+        dirpath, name = os.path.split(filepath)
+        dir_ = self.dir_index.get(dirpath)
+        if dir_ is None:
+            return None, None
+        rows = self.dir_rows(dir_)
+        i = bisect.bisect_left(rows, name, key=self.row_name)
+        if i == len(rows) or self.row_name(rows[i]) != name:
+            return None, None
+        row = rows[i]
+        if self.deleted is not None and self.deleted[row]:
+            return None, None
+        return row, dir_
+
+    def get(self, filepath, default=None):
+        row, dir_ = self.find(filepath)
+        return default if row is None else self.row_stat(row, dir_)
+
+    def __contains__(self, filepath):
+        return self.find(filepath)[0] is not None
+
+    def __getitem__(self, filepath):
+        row, dir_ = self.find(filepath)
+        if row is None:
+            raise KeyError(filepath)
+        return self.row_stat(row, dir_)
 
-def build_filedict(root):
-    filedict = {}
-    for root_, subdirs, files in os.walk(root):
-        for file_ in files:
-            filepath = os.path.join(root_, file_)
-            filedict[filepath] = get_filepath_data_for_filedict(filepath)
+    def __delitem__(self, filepath):
+        row, dir_ = self.find(filepath)
+        if row is None:
+            raise KeyError(filepath)
+        if self.deleted is None:
+            self.deleted = bytearray(len(self.ino))
+        self.deleted[row] = 1
+        self.count_deleted += 1
+
+    def __len__(self):
+        return len(self.ino) - self.count_deleted
+
+    def items(self):
+        for dir_, dirpath in enumerate(self.dirs):
+            for row in self.dir_rows(dir_):
+                if self.deleted is not None and self.deleted[row]:
+                    continue
+                yield os.path.join(dirpath, self.row_name(row)), self.row_stat(row, dir_)
+
+    def __iter__(self):
+        for filepath, stat in self.items():
+            yield filepath
+
+# filepath -> stat for all files in tree
+# used both as stat cache for merging and as state for post check
+def build_filedict(root, use_manifest=False, rules=None):
+    filedict = FileTable()
+    filedict.rules = rules
+    with phase('walk'):
+        for dirpath, files, dir_stat, from_manifest in scan_tree_dirs(root, use_manifest, rules):
+            filedict.add_dir(dirpath, files, dir_stat, from_manifest)
     return filedict
 
+# manifests of frozen backups
+# backup which is older than newest backup with same device-tag is not expected to change,
+# so after it was scanned, its dirs and files are recorded in db and later scans take files from there
+# for any dir which has same mtime as recorded (which changes if files are added, removed or renamed in it)
+# dirs are keyed by path relative to db location, so that workdir can be moved together with db
+def manifest_dir_key(dirpath):
+    return os.fsencode(os.path.relpath(os.path.abspath(dirpath), os.path.dirname(os.path.abspath(db_path))))
+
+# return (files, subdir names) of dir from manifest, or None if dir is not recorded or changed
+def manifest_get_dir(dirpath, dir_stat):
+    key = manifest_dir_key(dirpath)
+    row = db_read('select dev, mtime_ns from manifest_dirs where dir=?', (key,))
+    if row is None or row != (dir_stat.st_dev, dir_stat.st_mtime_ns):
+        return None
+    files = [(os.fsdecode(name), FileStat(mode, ino, dir_stat.st_dev, nlink, size, mtime_ns))
+             for name, mode, ino, nlink, size, mtime_ns in db_query('select name, mode, ino, nlink, size, mtime_ns from manifest_files where dir=?', (key,))]
+    files.sort(key=lambda file_: file_[0])
+    subdirs = sorted(os.path.basename(os.fsdecode(subdir_key))
+                     for subdir_key, in db_query('select dir from manifest_dirs where parent=?', (key,)))
+    return files, subdirs
+
+def manifest_delete_dir(key):
+    for subdir_key, in db_query('select dir from manifest_dirs where parent=?', (key,)):
+        manifest_delete_dir(subdir_key)
+    db_write('delete from manifest_files where dir=?', (key,))
+    db_write('delete from manifest_dirs where dir=?', (key,))
+
+# record dirs of filedict which were scanned from filesystem
+# dirs modified shortly before scan are not recorded, because their later modifications may not change mtime
+# subdirs of dir taken from manifest are its recorded subdirs, so dir is only recorded if all its subdirs are recorded
+MANIFEST_MTIME_MARGIN_NS = 2*10**9
+
+def write_manifest(filedict):
+    if get_db() is None or CONFIG_READONLY:
+        return
+    subdir_keys = {}
+    for dirpath in filedict.dirs:
+        subdir_keys.setdefault(os.path.dirname(dirpath), set()).add(manifest_dir_key(dirpath))
+    # dirs which are (or will be) recorded, decided bottom-up (dirs are in scan order, so subdirs come after their dir)
+    recorded = [False]*len(filedict.dirs)
+    unrecorded_parents = set()
+    for dir_ in reversed(range(len(filedict.dirs))):
+        dirpath = filedict.dirs[dir_]
+        if filedict.dir_from_manifest[dir_]:
+            recorded[dir_] = True
+        elif dirpath not in unrecorded_parents and filedict.dir_mtime_ns[dir_] and filedict.dir_mtime_ns[dir_] <= filedict.scan_start_ns-MANIFEST_MTIME_MARGIN_NS:
+            recorded[dir_] = True
+        if not recorded[dir_]:
+            unrecorded_parents.add(os.path.dirname(dirpath))
+    for dir_, dirpath in enumerate(filedict.dirs):
+        if filedict.dir_from_manifest[dir_] or not recorded[dir_]:
+            continue
+        key = manifest_dir_key(dirpath)
+        # subdirs which no longer exist
+        for subdir_key, in db_query('select dir from manifest_dirs where parent=?', (key,)):
+            if subdir_key not in subdir_keys.get(dirpath, ()):
+                manifest_delete_dir(subdir_key)
+        db_write('delete from manifest_files where dir=?', (key,))
+        db_write('insert or replace into manifest_dirs (dir, parent, dev, mtime_ns) values (?, ?, ?, ?)',
+                 (key, manifest_dir_key(os.path.dirname(dirpath)), filedict.dir_dev[dir_], filedict.dir_mtime_ns[dir_]))
+        for row in filedict.dir_rows(dir_):
+            db_write('insert into manifest_files (dir, name, mode, ino, nlink, size, mtime_ns) values (?, ?, ?, ?, ?, ?, ?)',
+                     (key, os.fsencode(filedict.row_name(row)), filedict.mode[row], filedict.ino[row], filedict.nlink[row], filedict.size[row], filedict.mtime_ns[row]))
+    db_commit()
+
 # verify that filepath does not have unwanted changes
 # assumes that filepath currently exists (but can be missing in files_dict which means file was created)
-def verify_file(files_dict, filepath, allow_new_files=False):
+def verify_file(files_dict, filepath, stat, allow_new_files=False):
     if not filepath in files_dict:
         if not allow_new_files:
             print(' new file', filepath)
             return False
         return True
-    stat = os.stat(filepath, follow_symlinks=False)
-    old_stat = files_dict[filepath]['stat']
+    old_stat = files_dict[filepath]
     del files_dict[filepath]
     if not stat.st_size == old_stat.st_size:
         print(' different size for', filepath)
         return False
-    if not stat.st_mtime <= old_stat.st_mtime:
+    if not stat.st_mtime_ns <= old_stat.st_mtime_ns:
         print(' mtime increased for', filepath)
         return False
     return True
 
-def verify_filedict(files_dict, root, allow_new_files=False):
+def verify_filedict(files_dict, root, allow_new_files=False, touched=None):
+    with phase('verify'):
+        return verify_filedict_(files_dict, root, allow_new_files, touched)
+
+# touched: paths which were modified, if given, only they are re-stat'ed (unless CONFIG_VERIFY is 'full')
+def verify_filedict_(files_dict, root, allow_new_files=False, touched=None):
     print('verifying filedict for', root)
     result = True
-    for root_, subdirs, files in os.walk(root):
-        for file_ in files:
-            filepath = os.path.join(root_, file_)
-            if not verify_file(files_dict, filepath, allow_new_files):
+    if touched is not None and CONFIG_VERIFY != 'full':
+        root_prefix = os.path.join(root, '')
+        for filepath in sorted(touched):
+            if not filepath.startswith(root_prefix):
+                continue
+            try:
+                stat = os.stat(filepath, follow_symlinks=False)
+                count('stat_calls')
+            except FileNotFoundError:
+                print(' missing file', filepath)
                 result = False
+                continue
+            if not verify_file(files_dict, filepath, stat, allow_new_files):
+                result = False
+        print('verification successful' if result else 'verification failed, see messages above')
+        return result
+    for filepath, stat in scan_tree(root, getattr(files_dict, 'rules', None)):
+        if not verify_file(files_dict, filepath, stat, allow_new_files):
+            result = False
     if len(files_dict):
         result = False
         print('missing files!')
@@ -148,196 +1220,1045 @@ def command(name):
     return register
 
 # for conditionally logging operations after result is known
-msg_buf = ''
+# per thread, so that messages of files processed in parallel don't mix
+msg_local = threading.local()
 
 def print_to_msg_buf(*strs):
-    global msg_buf
-    msg_buf += '\n' + ' '.join(str(str_) for str_ in strs)
+    if not hasattr(msg_local, 'buf'):
+        msg_local.buf = []
+    msg_local.buf.append(' '.join(str(str_) for str_ in strs))
 
 def drop_msg_buf():
-    global msg_buf
-    msg_buf = ''
+    msg_local.buf = []
 
-def print_msg_buf():
-    print(msg_buf[1:])
+def take_msg_buf():
+    msgs = '\n'.join(getattr(msg_local, 'buf', []))
     drop_msg_buf()
+    return msgs
+
+def print_msg_buf():
+    print(take_msg_buf())
+
+def print_msgs_for_result(res, msgs):
+    if CONFIG_LOG == 'all' or (CONFIG_LOG=='fail' and res==False) or (CONFIG_LOG=='fail_and_success' and res is not None):
+        print(msgs)
+
+# number of threads for file jobs, can be lowered in worker processes
+file_jobs = CONFIG_JOBS
+
+# like map(func, *args) for args in iterable, but run in file jobs thread pool
+# results are yielded in order of iterable, number of pending jobs is bounded
+def map_jobs(func, iterable):
+    if file_jobs <= 1:
+        for args in iterable:
+            yield func(*args)
+        return
+    with ThreadPoolExecutor(file_jobs) as executor:
+        pending = collections.deque()
+        for args in iterable:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= file_jobs*4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 # we don't need real date validity check
 def is_date(str_):
     parts = str_.split('-')
     return len(parts)==3 and len(parts[0])==4 and parts[0].isdigit() and len(parts[1])==2 and parts[1].isdigit and '01'<=parts[1]<='12' and len(parts[2])==2 and parts[2].isdigit() and '01'<=parts[1]<='31'
 
+# list yyyy-mm-dd_device-tag backup dirs in workdir, sorted by date
+def list_backups(workdir):
+    backups = []
+    for item in sorted(os.listdir(workdir)):
+        item_parts = item.split('_')
+        if len(item_parts)<2:
+            continue
+        if not is_date(item_parts[0]):
+            continue
+        if not os.path.isdir(os.path.join(workdir, item)):
+            continue
+        backups.append(item)
+    return backups
+
+# device-tag -> backups with this tag, sorted by date
+def group_backups_by_tag(workdir):
+    groups = {}
+    for backup in list_backups(workdir):
+        groups.setdefault(backup.split('_')[1], []).append(backup)
+    return groups
+
+# files of same dir are merged by same job in chunks, so that dirs of both backups are opened once per chunk
+MERGE_CHUNK_FILES = 256
+
+# yield args of merge_hardlink_files jobs
+# resume_after: files up to and including this file of old backup are skipped
+def iter_merge_hardlink_files(old_backup_root, old_backup_filedict, new_backup_root, new_backup_filedict, resume_after=None):
+    chunk = []
+    for filepath_old_backup, stat_old_backup in old_backup_filedict.items():
+        if resume_after is not None:
+            if filepath_old_backup == resume_after:
+                resume_after = None
+            continue
+        if chunk and (len(chunk) >= MERGE_CHUNK_FILES or os.path.dirname(chunk[0][0]) != os.path.dirname(filepath_old_backup)):
+            yield old_backup_root, new_backup_root, new_backup_filedict, chunk
+            chunk = []
+        chunk.append((filepath_old_backup, stat_old_backup))
+    if chunk:
+        yield old_backup_root, new_backup_root, new_backup_filedict, chunk
+
+# group chunks in windows of about JOURNAL_BATCH files, yielding (chunks, last filepath of window in scan order)
+# checkpoint is recorded after every window, and with CONFIG_IO_ORDER files are reordered within window
+def iter_merge_hardlink_windows(chunks):
+    window = []
+    files = 0
+    for args in chunks:
+        window.append(args)
+        files += len(args[3])
+        if files >= JOURNAL_BATCH:
+            yield order_merge_hardlink_window(window), window[-1][3][-1][0]
+            window = []
+            files = 0
+    if window:
+        yield order_merge_hardlink_window(window), window[-1][3][-1][0]
+
+def order_merge_hardlink_window(window):
+    if CONFIG_IO_ORDER not in ('inode', 'extent'):
+        return window
+    with phase('order'):
+        # files which don't need comparison are done first, others are ordered by key
+        skipped = []
+        pending = []
+        for old_backup_root, new_backup_root, new_backup_filedict, chunk in window:
+            for filepath_old_backup, stat_old_backup in chunk:
+                filepath_new_backup = new_backup_root+filepath_old_backup[len(old_backup_root):]
+                stat_new_backup = new_backup_filedict.get(filepath_new_backup)
+                args = old_backup_root, new_backup_root, new_backup_filedict, [(filepath_old_backup, stat_old_backup)]
+                if stat_new_backup is None or check_merge_stats_quiet(stat_old_backup, stat_new_backup) is not True:
+                    skipped.append(args)
+                    continue
+                offset = file_physical_offset(filepath_old_backup) if CONFIG_IO_ORDER == 'extent' else None
+                key = (0, offset) if offset is not None else (1, stat_old_backup.st_ino)
+                pending.append((key, filepath_old_backup, filepath_new_backup, stat_old_backup.st_size, args))
+        pending.sort(key=lambda item: item[0])
+    return itertools.chain(skipped, iter_prefetched(pending))
+
+# yield args of pending comparisons, prefetching files of next ones up to IO_READAHEAD_BYTES
+# only first CONFIG_CMP_BUFSIZE bytes of file are prefetched, rest is read ahead by kernel once file is read sequentially
+IO_READAHEAD_BYTES = 64*1024*1024
+
+def iter_prefetched(pending):
+    ahead = 0
+    ahead_bytes = 0
+    for key, filepath_old_backup, filepath_new_backup, size, args in pending:
+        while ahead < len(pending) and (ahead_bytes < IO_READAHEAD_BYTES or not ahead_bytes):
+            length = min(pending[ahead][3], CONFIG_CMP_BUFSIZE)
+            prefetch(pending[ahead][1], length)
+            prefetch(pending[ahead][2], length)
+            ahead_bytes += length*2
+            ahead += 1
+        yield args
+        ahead_bytes -= min(size, CONFIG_CMP_BUFSIZE)*2
+
+# files: (filepath, stat) of files of old backup in same dir
+# return [(filepath, res, msgs), ...]
+def merge_hardlink_files(old_backup_root, new_backup_root, new_backup_filedict, files):
+    results = []
+    dir_fd_old_backup = dir_fd_new_backup = None
+    try:
+        for filepath_old_backup, stat_old_backup in files:
+            filepath_new_backup = new_backup_root+filepath_old_backup[len(old_backup_root):]
+            stat_new_backup = new_backup_filedict.get(filepath_new_backup)
+            print_to_msg_buf(filepath_old_backup[len(old_backup_root):])
+            if stat_new_backup is None:
+                print_to_msg_buf(' does not exist in new_backup tree')
+                results.append((filepath_old_backup, None, take_msg_buf()))
+                continue
+            # dirs are only opened if there are several files to merge in them
+            if dir_fd_old_backup is None and len(files) > 1:
+                dir_fd_old_backup = os.open(os.path.dirname(filepath_old_backup), os.O_RDONLY | os.O_DIRECTORY)
+                dir_fd_new_backup = os.open(os.path.dirname(filepath_new_backup), os.O_RDONLY | os.O_DIRECTORY)
+            res = merge_file(filepath_old_backup,
+                             filepath_new_backup,
+                             stat_old_backup,
+                             stat_new_backup,
+                             dir_fd_old_backup,
+                             dir_fd_new_backup)
+            results.append((filepath_old_backup, res, take_msg_buf()))
+    finally:
+        if dir_fd_old_backup is not None:
+            os.close(dir_fd_old_backup)
+        if dir_fd_new_backup is not None:
+            os.close(dir_fd_new_backup)
+    return results
+
 # deduplicate pair of backups which can have identical files
 # given src and dst, for any file src/subdirs/filename, for which there is identical dst/subdirs/filename, replace dst/subdirs/filename with hardlink to src/subdirs/filename
 # can be seen as conditional hardlink copying (`cp -l`) of src over dst, which is only done for subset of files in src for which identical files exist in dst so that replacing them does not change anything in dst
 @command('merge-hardlink')
 def merge_hardlink(old_backup_root, new_backup_root):
     print('merge_hardlink old_backup={0} new_backup={1}'.format(old_backup_root, new_backup_root))
+    # paths of new backup are made by replacing prefix of paths of old backup, so roots must not differ by trailing slash
+    old_backup_root = os.path.normpath(old_backup_root)
+    new_backup_root = os.path.normpath(new_backup_root)
     result = True
-    # build dicts for post check
-    old_backup_filedict = {}
-    new_backup_filedict = build_filedict(new_backup_root)
-    for root, subdirs, files in os.walk(old_backup_root):
-        for file_ in files:
-            filepath_old_backup = os.path.join(root, file_)
-            print_to_msg_buf(filepath_old_backup[len(old_backup_root):])
-            old_backup_filedict[filepath_old_backup] = get_filepath_data_for_filedict(filepath_old_backup)
-            filepath_new_backup = os.path.join(new_backup_root, root[len(old_backup_root)+1:], file_)
-            if not os.path.exists(filepath_new_backup):
-                print_to_msg_buf(' does not exist in new_backup tree')
-                if CONFIG_LOG == 'all':
-                    print_msg_buf()
-                else:
-                    drop_msg_buf()
-                continue
-            res = merge_file(filepath_old_backup,
-                             filepath_new_backup)
-            if CONFIG_LOG == 'all' or (CONFIG_LOG=='fail' and res==False) or (CONFIG_LOG=='fail_and_success' and res is not None):
-                print_msg_buf()
-            else:
-                drop_msg_buf()
-    # post check
-    if not verify_filedict(old_backup_filedict, old_backup_root):
+    start = time.perf_counter()
+    counters_before = dict(counters)
+    # build dicts for merging and post check
+    rules = get_rules('merge-hardlink')
+    old_backup_filedict = build_filedict(old_backup_root, use_manifest=True, rules=rules)
+    new_backup_filedict = build_filedict(new_backup_root, use_manifest=True, rules=rules)
+    touched_paths.clear()
+    # interrupted run is resumed after last checkpoint, unless old backup changed so that checkpoint file is gone
+    resume_after = get_checkpoint(old_backup_root, new_backup_root)
+    if resume_after is not None and resume_after not in old_backup_filedict:
+        resume_after = None
+    if resume_after is not None:
+        print('resuming interrupted run after', resume_after[len(old_backup_root):])
+    chunks = iter_merge_hardlink_files(old_backup_root, old_backup_filedict, new_backup_root, new_backup_filedict, resume_after)
+    for window, last_filepath in iter_merge_hardlink_windows(chunks):
+        for results in map_jobs(merge_hardlink_files, window):
+            for filepath, res, msgs in results:
+                print_msgs_for_result(res, msgs)
+        set_checkpoint(old_backup_root, new_backup_root, last_filepath)
+    delete_checkpoint(old_backup_root, new_backup_root)
+    db_commit()
+    if not verify_filedict(old_backup_filedict, old_backup_root, touched=touched_paths):
         result = False
-    if not verify_filedict(new_backup_filedict, new_backup_root):
+    if not verify_filedict(new_backup_filedict, new_backup_root, touched=touched_paths):
         result = False
+    # old backup is older than new backup with same device-tag, so it is frozen
+    if result:
+        write_manifest(old_backup_filedict)
+    emit_metrics('merge_hardlink', old_backup=old_backup_root, new_backup=new_backup_root, result=result, seconds=time.perf_counter()-start, counters=counters_delta(counters_before))
     return result
 
 # iterate all yyyy-mm-dd_device-tag backups
-# for any backup, iterate all later backups with same device-tag and merge with current
+# chain mode: for any backup, merge previous backup with same device-tag with it
+# files which are identical in several backups end up hardlinked along the chain, so that no pairs of non-adjacent backups have to be merged
+# (file which is missing in some backup is not merged across the gap)
+# all mode: for any backup, merge it with all later backups with same device-tag
+# pairs which were successfully merged are recorded in db and skipped by later runs
+# (unless some files were refused because of CONFIG_DST_HARDLINK_COUNT_MULTIPLE or CONFIG_DST_MTIME_OLDER, so that they are merged again with other config)
 @command('merge-hardlink-all')
 def merge_hardlink_all(workdir='.'):
     result = True
-    for item1 in sorted(os.listdir(workdir)):
-        if not os.path.isdir(os.path.join(workdir, item1)):
+    open_workdir_db(workdir)
+    chains = []
+    for tag, backups in group_backups_by_tag(workdir).items():
+        pairs = []
+        for i, new_backup in enumerate(backups):
+            old_backups = backups[:i] if CONFIG_MERGE_ALL_MODE=='all' else backups[max(i-1, 0):i]
+            pairs.extend((old_backup, new_backup) for old_backup in old_backups)
+        chains.append(pairs)
+    processes = min(CONFIG_JOBS, len(chains))
+    if processes <= 1:
+        for pairs in chains:
+            if not merge_hardlink_chain(workdir, pairs):
+                result = False
+        return result
+    # connection must not be inherited by worker processes
+    db_close()
+    with ProcessPoolExecutor(processes, initializer=init_worker_process, initargs=(db_path, max(1, CONFIG_JOBS//processes))) as executor:
+        # output of worker is printed at once when chain is done
+        for res, out, counters_, slowest_files_, planned_files_ in executor.map(merge_hardlink_chain_worker, [(workdir, pairs) for pairs in chains]):
+            print(out, end='')
+            merge_metrics(counters_, slowest_files_)
+            # so that ops planned later by this process (accumulate of anticloud-auto) rely on files as changed by planned merges
+            with plan_lock:
+                planned_files.update(planned_files_)
+            if not res:
+                result = False
+    return result
+
+def merge_hardlink_chain(workdir, pairs):
+    result = True
+    for old_backup, new_backup in pairs:
+        if is_merged(old_backup, new_backup):
+            print('merge_hardlink old_backup={0} new_backup={1} already merged, skipping'.format(old_backup, new_backup))
             continue
-        item1_parts = item1.split('_')
-        if len(item1_parts)<2:
+        refused_before = counters['files_refused_by_config']
+        if not merge_hardlink(os.path.join(workdir, old_backup), os.path.join(workdir, new_backup)):
+            result = False
             continue
-        if not is_date(item1_parts[0]):
+        if counters['files_refused_by_config'] != refused_before:
+            print('merge_hardlink old_backup={0} new_backup={1} has files refused by config, not recording as merged'.format(old_backup, new_backup))
             continue
-        for item2 in sorted(os.listdir(workdir)):
-            if item2 == item1:
-                continue
-            if not os.path.isdir(os.path.join(workdir, item2)):
-                continue
-            item2_parts = item2.split('_')
-            if len(item2_parts)<2:
-                continue
-            # same device tag
-            if item2_parts[1] != item1_parts[1]:
-                continue
-            if not is_date(item2_parts[0]):
-                continue
-            # date of item2 newer
-            if item2_parts[0]<item1_parts[0]:
-                continue
-            if not merge_hardlink(os.path.join(workdir, item1), os.path.join(workdir, item2)):
-                result = False
+        if not CONFIG_READONLY:
+            set_merged(old_backup, new_backup)
+    db_commit()
     return result
 
+def merge_hardlink_chain_worker(args):
+    counters.clear()
+    slowest_files.clear()
+    planned_files.clear()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        try:
+            res = merge_hardlink_chain(*args)
+        finally:
+            # worker process is kept by pool, journal is removed and db is committed when chain is done
+            db_close()
+    return res, out.getvalue(), counters, slowest_files, planned_files
+
+def init_worker_process(db_path_, file_jobs_):
+    global db_path, db_conn, file_jobs, db_commit_interval
+    db_path = db_path_
+    db_conn = None
+    file_jobs = file_jobs_
+    db_commit_interval = 1
+
+# files: (filepath, stat) of files in backup with same name
+# index of accumulator dir, built once and updated in memory as files are hardlinked to it
+# filedict keeps state when index was built, changes are kept separately
+# (index can be kept for several runs, post check only checks changes since previous one)
+class AccumulatorIndex:
+    def __init__(self, accumulator):
+        self.accumulator = accumulator
+        self.filedict = build_filedict(accumulator)
+        # filepath -> stat of files which were created or replaced since index was built
+        # (accumulate_files jobs never share filepath, so no lock is needed)
+        self.changed = {}
+        # filepath -> stat before first change since previous post check, for files which existed
+        self.before = {}
+        # readonly mode: filepath -> (path, stat) of backup file which would be hardlinked to accumulator, for files which don't exist
+        self.planned = {}
+        self.lock = threading.Lock()
+        # files are linked and stat'ed relative to accumulator dir (it doesn't exist in readonly mode if it wasn't created yet)
+        self.dir_fd = os.open(accumulator, os.O_RDONLY | os.O_DIRECTORY) if os.path.isdir(accumulator) else None
+
+    def get(self, filepath):
+        stat = self.changed.get(filepath)
+        if stat is not None:
+            return stat
+        with self.lock:
+            if self.filedict is None:
+                self.filedict = build_filedict(self.accumulator)
+        return self.filedict.get(filepath)
+
+    def set(self, filepath, stat):
+        if filepath not in self.before:
+            stat_before = self.get(filepath)
+            if stat_before is not None:
+                self.before[filepath] = stat_before
+        self.changed[filepath] = stat
+
+    def verify(self):
+        if CONFIG_VERIFY == 'full':
+            # whole tree is checked against state when index was built, which is consumed by check, so index is rebuilt if it is used again
+            result = verify_filedict(self.filedict, self.accumulator, allow_new_files=True)
+            self.filedict = None
+            self.changed = {}
+        else:
+            result = verify_filedict(self.before, self.accumulator, allow_new_files=True, touched=touched_paths)
+        self.before = {}
+        return result
+
+    def close(self):
+        if self.dir_fd is not None:
+            os.close(self.dir_fd)
+            self.dir_fd = None
+
+def accumulate_files(backup_root, files, accumulator_index):
+    results = []
+    filepath_accumulator = os.path.join(accumulator_index.accumulator, os.path.basename(files[0][0]))
+    stat_accumulator = accumulator_index.get(filepath_accumulator)
+    planned = accumulator_index.planned.get(filepath_accumulator)
+    for filepath_snapshot_backup, stat_snapshot_backup in files:
+        print_to_msg_buf(filepath_snapshot_backup[len(backup_root):])
+        if planned is not None:
+            # readonly mode: accumulator file doesn't exist, so it is only compared with backup file it would be hardlink of
+            print_to_msg_buf(' exists in accumulator only as planned hardlink of', planned[0])
+            res = check_merge_stats(stat_snapshot_backup, planned[1])
+            if res is True:
+                if files_equal(filepath_snapshot_backup, planned[0], stat_snapshot_backup, planned[1]):
+                    print_to_msg_buf(' same contents, readonly mode, merge can only be planned once planned hardlink exists')
+                else:
+                    print_to_msg_buf(' different contents, can\'t merge')
+                    res = False
+            results.append((res, take_msg_buf()))
+            continue
+        if stat_accumulator is None:
+            print_to_msg_buf(' does not exist in accumulator, creating hardlink')
+            if not CONFIG_READONLY:
+                with phase('link'):
+                    os.link(filepath_snapshot_backup, at(filepath_accumulator, accumulator_index.dir_fd), dst_dir_fd=accumulator_index.dir_fd)
+                touched_paths.add(filepath_accumulator)
+                stat_accumulator = stat_snapshot_backup
+                accumulator_index.set(filepath_accumulator, stat_accumulator)
+            else:
+                print_to_msg_buf(' readonly mode, skipping modifying op')
+                src_fingerprint, src_nlink = planned_fingerprint(filepath_snapshot_backup, stat_snapshot_backup)
+                plan_op('link-new', src=os.path.abspath(filepath_snapshot_backup), dst=os.path.abspath(filepath_accumulator),
+                        src_fingerprint=src_fingerprint)
+                set_planned_fingerprint(filepath_snapshot_backup, src_fingerprint, src_nlink+1)
+                set_planned_fingerprint(filepath_accumulator, src_fingerprint, src_nlink+1)
+                planned = accumulator_index.planned[filepath_accumulator] = (filepath_snapshot_backup, stat_snapshot_backup)
+            results.append((True, take_msg_buf()))
+            continue
+        res = merge_file(filepath_snapshot_backup,
+                         filepath_accumulator,
+                         stat_snapshot_backup,
+                         stat_accumulator,
+                         dst_dir_fd=accumulator_index.dir_fd)
+        if res:
+            stat_accumulator = os.stat(at(filepath_accumulator, accumulator_index.dir_fd), dir_fd=accumulator_index.dir_fd, follow_symlinks=False)
+            accumulator_index.set(filepath_accumulator, stat_accumulator)
+        results.append((res, take_msg_buf()))
+    return results
+
 # collect files from backup to accumulator dir
 # given backup (DCIM subdir) and accumulator dir, for each photo in backup (incl. subdirs) check if it is in accumulator; if not, create hardlink in accumulator, else merge
 # backup_root: snaphot backup, src in "cp -l src dst" BUT identical files are replaced with ones from dst?
 # accumulator: accumulator dir, dst in "cp -l src dst"
+# accumulator_index: index shared by multiple calls, accumulator post check is then left to caller
+# frozen: backup is not newest backup with its device-tag, so manifest is recorded for it
 @command('accumulate')
-def accumulate(backup_root, accumulator):
+def accumulate(backup_root, accumulator, accumulator_index=None, frozen=False):
     print('accumulate backup={0} accumulator={1}'.format(backup_root, accumulator))
     result = True
-    snapshot_backup_filedict = build_filedict(backup_root)
-    accumulator_filedict = build_filedict(accumulator)
-    for root, subdirs, files in os.walk(backup_root):
-        # TODO settings
-        # skip hidden
-        files = [f for f in files if not f.startswith('.')]
-        subdirs[:] = [s for s in subdirs if not s.startswith('.')]
-        # skip json
-        files = [f for f in files if not f.endswith('.json')]
-        for file_ in files:
-            filepath_snapshot_backup = os.path.join(root, file_)
-            print_to_msg_buf(filepath_snapshot_backup[len(backup_root):])
-            filepath_accumulator = os.path.join(accumulator, file_)
-            if not os.path.exists(filepath_accumulator):
-                print_to_msg_buf(' does not exist in accumulator, creating hardlink')
-                if not CONFIG_READONLY:
-                    os.link(filepath_snapshot_backup, filepath_accumulator)
-                else:
-                    print_to_msg_buf(' readonly mode, skipping modifying op')
-                print_msg_buf()
-                continue
-            res = merge_file(filepath_snapshot_backup,
-                             filepath_accumulator)
-            if CONFIG_LOG == 'all' or (CONFIG_LOG=='fail' and res==False) or (CONFIG_LOG=='fail_and_success' and res is not None):
-                print_msg_buf()
-            else:
-                drop_msg_buf()
-    if not verify_filedict(snapshot_backup_filedict, backup_root):
-        result = False
-    if not verify_filedict(accumulator_filedict, accumulator, allow_new_files=True):
+    start = time.perf_counter()
+    counters_before = dict(counters)
+    snapshot_backup_filedict = build_filedict(backup_root, use_manifest=True, rules=get_rules('accumulate'))
+    own_index = accumulator_index is None
+    if own_index:
+        touched_paths.clear()
+        accumulator_index = AccumulatorIndex(accumulator)
+    # files with same name from different subdirs go to same path in accumulator, so they are processed by same job
+    files_by_name = {}
+    for filepath, stat in snapshot_backup_filedict.items():
+        files_by_name.setdefault(os.path.basename(filepath), []).append((filepath, stat))
+    for results in map_jobs(accumulate_files, ((backup_root, files, accumulator_index) for files in files_by_name.values())):
+        for res, msgs in results:
+            print_msgs_for_result(res, msgs)
+    db_commit()
+    if not verify_filedict(snapshot_backup_filedict, backup_root, touched=touched_paths):
         result = False
+    if own_index:
+        if not accumulator_index.verify():
+            result = False
+        accumulator_index.close()
+    if result and frozen:
+        write_manifest(snapshot_backup_filedict)
+    emit_metrics('accumulate', backup=backup_root, accumulator=accumulator, result=result, seconds=time.perf_counter()-start, counters=counters_delta(counters_before))
     return result
 
-# for any yyyy-mm-dd_device-tag backup, accumulate files from DCIM/ subdir to accumulator
-# google takeout?
-@command('accumulate-all')
-def accumulate_all(workdir='.'):
-    result = True
+# accumulator dir of workdir, created if it doesn't exist, and its index
+def open_accumulator_index(workdir):
     accumulator = os.path.join(workdir, 'accumulator')
     if not os.path.exists(accumulator):
         if not CONFIG_READONLY:
             os.makedirs(accumulator)
         else:
             print(' readonly mode, skipping modifying op')
-    for item1 in os.listdir(workdir):
-        if not os.path.isdir(os.path.join(workdir, item1)):
-            continue
-        item1_parts = item1.split('_')
-        if len(item1_parts)<2:
-            continue
-        #item1_device_tag = item1_parts[1]
-        if not is_date(item1_parts[0]):
-            continue
+            plan_op('mkdir', path=os.path.abspath(accumulator))
+    return AccumulatorIndex(accumulator)
+
+# for any yyyy-mm-dd_device-tag backup, accumulate files from DCIM/ subdir to accumulator
+# google takeout?
+@command('accumulate-all')
+def accumulate_all(workdir='.', accumulator_index=None):
+    result = True
+    open_workdir_db(workdir)
+    # accumulator is indexed once for all backups (or index is kept by caller)
+    touched_paths.clear()
+    own_index = accumulator_index is None
+    if own_index:
+        accumulator_index = open_accumulator_index(workdir)
+    newest_backups = [backups[-1] for backups in group_backups_by_tag(workdir).values()]
+    for item1 in list_backups(workdir):
         for subdir in CONFIG_ACCUMULATE_SUBDIRS:
             item1_subdir = os.path.join(workdir, item1, subdir)
-            if os.path.exists(item1_subdir) and os.path.isdir(item1_subdir):
-                if not accumulate(item1_subdir, accumulator):
+            if os.path.isdir(item1_subdir):
+                if not accumulate(item1_subdir, accumulator_index.accumulator, accumulator_index, item1 not in newest_backups):
                     result = False
+    if not accumulator_index.verify():
+        result = False
+    if own_index:
+        accumulator_index.close()
     return result
 
-#@command('list-files-with-hardlink-count-single')
+# inotify, via libc
+IN_MODIFY =      0x00000002
+IN_ATTRIB =      0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO =    0x00000080
+IN_CREATE =      0x00000100
+IN_DELETE =      0x00000200
+IN_Q_OVERFLOW =  0x00004000
+IN_ONLYDIR =     0x01000000
+IN_ISDIR =       0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # wd -> path
+        self.paths = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed', path)
+        self.paths[wd] = path
+        return wd
+
+    def rm_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+        self.paths.pop(wd, None)
+
+    # return [(path of watched dir, name, mask), ...], empty if there are no events within timeout
+    # path is None for events of removed watches
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        buf = os.read(self.fd, 64*1024)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(buf[offset:offset+length].rstrip(b'\0'))
+            offset += length
+            events.append((self.paths.get(wd), name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
 
-#@command('list-files-unique')
+WATCH_BACKUP_MASK = IN_CREATE | IN_MOVED_TO | IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB | IN_DELETE | IN_ONLYDIR
 
-#@command('list-files-shared')
+def is_backup_name(name):
+    parts = name.split('_')
+    return len(parts) >= 2 and is_date(parts[0])
+
+# watch dir of backup and its subdirs for changes
+# subdirs are watched before they are listed, so that files created in between aren't missed
+def watch_backup_tree(inotify, path, wds):
+    try:
+        wds.append(inotify.add_watch(path, WATCH_BACKUP_MASK))
+        with os.scandir(path) as it:
+            subdirs = [entry.path for entry in it if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        return
+    for subdir in subdirs:
+        watch_backup_tree(inotify, subdir, wds)
+
+# merge new backup with previous (and next, if it's not newest) backup with same device-tag and accumulate it
+def watch_process_backup(workdir, backup, accumulator_index):
+    print('watch: processing backup', backup)
+    result = True
+    backups = group_backups_by_tag(workdir).get(backup.split('_')[1], [])
+    if backup not in backups:
+        return result
+    i = backups.index(backup)
+    pairs = list(zip(backups[max(i-1, 0):i+1], backups[i:i+2]))
+    if not merge_hardlink_chain(workdir, [pair for pair in pairs if pair[0] != pair[1]]):
+        result = False
+    touched_paths.clear()
+    for subdir in CONFIG_ACCUMULATE_SUBDIRS:
+        backup_subdir = os.path.join(workdir, backup, subdir)
+        if os.path.isdir(backup_subdir):
+            if not accumulate(backup_subdir, accumulator_index.accumulator, accumulator_index, i < len(backups)-1):
+                result = False
+    if not accumulator_index.verify():
+        result = False
+    db_commit()
+    print('watch: backup {0} {1}'.format(backup, 'processed' if result else 'processed with failures, check messages above'))
+    return result
+
+# stay running and process new backups as they appear in workdir
+# existing backups are processed first, like by anticloud-auto
+# new backup is processed once there were no changes in it for CONFIG_WATCH_SETTLE seconds (so that it is completely copied)
+# accumulator index is kept between backups, old backups are scanned from manifests
+@command('watch')
+def watch(workdir='.'):
+    result = True
+    open_workdir_db(workdir)
+    inotify = Inotify()
+    inotify.add_watch(workdir, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+    # backup -> time of last change, and wds of its dirs
+    pending = {}
+    watched = {}
+    if not merge_hardlink_all(workdir):
+        result = False
+    accumulator_index = open_accumulator_index(workdir)
+    if not accumulate_all(workdir, accumulator_index):
+        result = False
+    print('watch: waiting for new backups in', workdir)
+    try:
+        while True:
+            timeout = min(pending.values())+CONFIG_WATCH_SETTLE-time.monotonic() if pending else None
+            for dirpath, name, mask in inotify.read(max(timeout, 0) if timeout is not None else None):
+                if mask & IN_Q_OVERFLOW:
+                    # events were lost, so all watched backups are waited for again
+                    for backup in watched:
+                        pending[backup] = time.monotonic()
+                    continue
+                if dirpath is None:
+                    continue
+                if dirpath == workdir:
+                    if not (mask & IN_ISDIR and is_backup_name(name)) or name in watched:
+                        continue
+                    backup = name
+                    watched[backup] = []
+                    watch_backup_tree(inotify, os.path.join(workdir, backup), watched[backup])
+                else:
+                    backup = os.path.relpath(dirpath, workdir).split(os.sep)[0]
+                    if backup not in watched:
+                        continue
+                    if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                        watch_backup_tree(inotify, os.path.join(dirpath, name), watched[backup])
+                pending[backup] = time.monotonic()
+            for backup, last_change in list(pending.items()):
+                if time.monotonic()-last_change < CONFIG_WATCH_SETTLE:
+                    continue
+                # backup is not watched while it is processed, so that own changes are not seen as changes of copy
+                del pending[backup]
+                for wd in watched.pop(backup):
+                    inotify.rm_watch(wd)
+                if not watch_process_backup(workdir, backup, accumulator_index):
+                    result = False
+    except KeyboardInterrupt:
+        pass
+    finally:
+        accumulator_index.close()
+        inotify.close()
+    return result
+
+# bytes copied per copy_file_range/sendfile call
+COPY_CHUNK = 64*1024*1024
+
+# copy file content in kernel, with copy_file_range (which can share extents on filesystems which support it) or sendfile
+def copy_file(src, dst, stat):
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, S_IMODE(stat.st_mode))
+        try:
+            use_copy_file_range = hasattr(os, 'copy_file_range')
+            while True:
+                if use_copy_file_range:
+                    try:
+                        n = os.copy_file_range(src_fd, dst_fd, COPY_CHUNK)
+                    except OSError as e:
+                        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                            raise
+                        # both file offsets are where copying stopped, so it is continued with sendfile
+                        use_copy_file_range = False
+                        continue
+                else:
+                    n = os.sendfile(dst_fd, src_fd, None, COPY_CHUNK)
+                if not n:
+                    break
+                count('bytes_copied', n)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    os.utime(dst, ns=(stat.st_mtime_ns, stat.st_mtime_ns))
+
+# prev_path and prev_stat: same file in previous backup, if it exists
+def ingest_file(src_path, dst_path, stat, prev_path, prev_stat):
+    print_to_msg_buf(src_path)
+    if S_ISLNK(stat.st_mode):
+        print_to_msg_buf(' symlink, copying')
+        if not CONFIG_READONLY:
+            os.symlink(os.readlink(src_path), dst_path)
+        return True, take_msg_buf()
+    if not S_ISREG(stat.st_mode):
+        print_to_msg_buf(' not regular file, skipping')
+        return False, take_msg_buf()
+    if prev_stat is not None and prev_stat.st_size == stat.st_size and prev_stat.st_mtime_ns == stat.st_mtime_ns:
+        if CONFIG_INGEST_VERIFY != 'hash' or file_hash(src_path, stat) == file_hash(prev_path, prev_stat):
+            # unchanged since previous backup, nothing is copied
+            if not CONFIG_READONLY:
+                with phase('link'):
+                    os.link(prev_path, dst_path)
+            count('files_linked')
+            return None, take_msg_buf()
+        print_to_msg_buf(' same size and mtime as in previous backup, but different contents')
+    print_to_msg_buf(' new or changed, copying')
+    if not CONFIG_READONLY:
+        with phase('copy'):
+            copy_file(src_path, dst_path, stat)
+    else:
+        print_to_msg_buf(' readonly mode, skipping modifying op')
+    count('files_copied')
+    return True, take_msg_buf()
+
+# create new yyyy-mm-dd_tag backup of src tree (e.g. mounted phone storage) for today in workdir, like rsync --link-dest
+# files which have same path, size and mtime as in previous backup with same device-tag are hardlinked to it, others are copied
+# backup is written to hidden tmp dir and renamed when it is complete, so that partial backup is never seen as backup
+# (tmp dir is removed if ingest fails, and tmp dir left by interrupted ingest is removed by next one)
+@command('ingest')
+def ingest(src, workdir, tag):
+    result = True
+    open_workdir_db(workdir)
+    backup = '{0}_{1}'.format(time.strftime('%Y-%m-%d'), tag)
+    backup_root = os.path.join(workdir, backup)
+    if os.path.exists(backup_root):
+        print('backup already exists:', backup_root)
+        return False
+    rules = get_rules('ingest')
+    prev_backups = [prev_backup for prev_backup in group_backups_by_tag(workdir).get(tag, []) if prev_backup < backup]
+    prev_root = os.path.join(workdir, prev_backups[-1]) if prev_backups else None
+    prev_filedict = build_filedict(prev_root, use_manifest=True, rules=rules) if prev_root else FileTable()
+    print('ingest src={0} backup={1} previous_backup={2}'.format(src, backup_root, prev_root))
+    tmp_root = os.path.join(workdir, '.anticloud-ingest-'+backup)
+    if not CONFIG_READONLY:
+        if os.path.lexists(tmp_root):
+            print('removing tmp dir left by interrupted ingest:', tmp_root)
+            shutil.rmtree(tmp_root)
+        os.mkdir(tmp_root)
+    def iter_files():
+        for dirpath, files, dir_stat, from_manifest in scan_tree_dirs(src, rules=rules):
+            rel_dir = os.path.relpath(dirpath, src)
+            if not CONFIG_READONLY and rel_dir != '.':
+                # dir is created before jobs of its files are submitted
+                os.mkdir(os.path.join(tmp_root, rel_dir))
+            for name, stat in files:
+                rel_path = os.path.normpath(os.path.join(rel_dir, name))
+                prev_path = os.path.join(prev_root, rel_path) if prev_root else None
+                yield os.path.join(dirpath, name), os.path.join(tmp_root, rel_path), stat, prev_path, prev_filedict.get(prev_path) if prev_path else None
+    try:
+        for res, msgs in map_jobs(ingest_file, iter_files()):
+            if res == False:
+                result = False
+            print_msgs_for_result(res, msgs)
+    except BaseException:
+        if not CONFIG_READONLY:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+        raise
+    db_commit()
+    if not CONFIG_READONLY:
+        os.rename(tmp_root, backup_root)
+    print('files linked from previous backup: {0}, copied: {1} ({2})'.format(counters['files_linked'], counters['files_copied'], size_human(counters['bytes_copied'])))
+    return result
+
+# hash of first and last block, to narrow down groups of same size files before reading them in full
+PARTIAL_HASH_BLOCKSIZE = 64*1024
+
+def file_partial_hash(path, size):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        hasher.update(f.read(PARTIAL_HASH_BLOCKSIZE))
+        if size > PARTIAL_HASH_BLOCKSIZE:
+            f.seek(max(PARTIAL_HASH_BLOCKSIZE, size-PARTIAL_HASH_BLOCKSIZE))
+            hasher.update(f.read(PARTIAL_HASH_BLOCKSIZE))
+    return hasher.digest()
+
+# split groups of inodes by key func, dropping groups which can't have duplicates
+def split_inode_groups(groups, key_func):
+    result = []
+    for group in groups:
+        subgroups = {}
+        for inode in group:
+            subgroups.setdefault(key_func(inode), []).append(inode)
+        result.extend(subgroup for subgroup in subgroups.values() if len(subgroup)>1)
+    return result
+
+# deduplicate identical files in all yyyy-mm-dd_device-tag backups regardless of their paths
+# candidates are grouped by size, then by partial hash, then by full hash, so that most files are never read in full
+# for any group of identical files, keep inode with most hardlinks (then oldest mtime) and merge other files into it
+@command('dedup-global')
+def dedup_global(workdir='.'):
+    print('dedup_global workdir={0}'.format(workdir))
+    result = True
+    open_workdir_db(workdir)
+    backup_filedicts = {}
+    # size -> (st_dev, st_ino) -> {'stat': stat, 'paths': [paths]}
+    by_size = {}
+    for backup in list_backups(workdir):
+        backup_root = os.path.join(workdir, backup)
+        filedict = backup_filedicts[backup_root] = build_filedict(backup_root, use_manifest=True, rules=get_rules('dedup-global'))
+        for filepath, stat in filedict.items():
+            if not S_ISREG(stat.st_mode) or not stat.st_size:
+                continue
+            inodes = by_size.setdefault(stat.st_size, {})
+            inodes.setdefault((stat.st_dev, stat.st_ino), {'stat': stat, 'paths': []})['paths'].append(filepath)
+    groups = [list(inodes.values()) for inodes in by_size.values() if len(inodes)>1]
+    count_size = sum(len(group) for group in groups)
+    # small files are read in full by partial hash anyway
+    groups = split_inode_groups(groups, lambda inode: file_partial_hash(inode['paths'][0], inode['stat'].st_size) if inode['stat'].st_size > 2*PARTIAL_HASH_BLOCKSIZE else None)
+    count_partial = sum(len(group) for group in groups)
+    groups = split_inode_groups(groups, lambda inode: file_hash(inode['paths'][0], inode['stat']))
+    count_full = sum(len(group) for group in groups)
+    db_commit()
+    print('inodes with same size: {0}, same partial hash: {1}, same full hash: {2}'.format(count_size, count_partial, count_full))
+    touched_paths.clear()
+    for group in groups:
+        keep = min(group, key=lambda inode: (-inode['stat'].st_nlink, inode['stat'].st_mtime_ns))
+        for inode in group:
+            if inode is keep:
+                continue
+            for filepath in inode['paths']:
+                print_to_msg_buf(filepath[len(workdir):])
+                res = merge_file(keep['paths'][0], filepath, keep['stat'], inode['stat'])
+                print_msgs_for_result(res, take_msg_buf())
+    db_commit()
+    # post check
+    for backup_root, filedict in backup_filedicts.items():
+        if not verify_filedict(filedict, backup_root, touched=touched_paths):
+            result = False
+    return result
+
+# index of files of all backups and accumulator of workdir, for queries by inode and size
+# like manifests, dirs are keyed by path relative to db location, and files of dir are only listed and stat'ed again if dir mtime changed
+# (so files are assumed to not be modified in place, and hardlink counts are as of last listing of dir)
+# unlike manifests, it has dirs of all backups, dirs modified shortly before refresh are recorded with mtime 0 so that they are listed again
+# when hardlinks are removed or added in dirs which are listed again or deleted, other hardlinks of their inodes are stat'ed again,
+# so that hardlink counts of files in unchanged dirs are updated too (e.g. when one of backups sharing file is deleted)
+# changed_inodes: (size, dev, ino) of inodes with multiple hardlinks whose hardlinks were removed or added
+def index_delete_dir(key, changed_inodes):
+    for subdir_key, in db_query('select dir from index_dirs where parent=?', (key,)):
+        index_delete_dir(subdir_key, changed_inodes)
+    changed_inodes.update(db_query('select size, dev, ino from index_files where dir=? and nlink > 1', (key,)))
+    db_write('delete from index_files where dir=?', (key,))
+    db_write('delete from index_dirs where dir=?', (key,))
+
+def index_refresh(workdir):
+    with phase('index'):
+        scan_start_ns = time.time_ns()
+        workdir_key = manifest_dir_key(workdir)
+        roots = list_backups(workdir)
+        if os.path.isdir(os.path.join(workdir, 'accumulator')):
+            roots.append('accumulator')
+        root_keys = set()
+        changed_inodes = set()
+        refreshed_dirs = set()
+        for root in roots:
+            root_key = manifest_dir_key(os.path.join(workdir, root))
+            root_keys.add(root_key)
+            stack = [(os.path.join(workdir, root), workdir_key)]
+            while stack:
+                dirpath, parent_key = stack.pop()
+                stack.extend((subdir, manifest_dir_key(dirpath)) for subdir in index_refresh_dir(dirpath, parent_key, root_key, scan_start_ns, changed_inodes, refreshed_dirs))
+        # backups which were deleted
+        for key, in db_query('select dir from index_dirs where parent=?', (workdir_key,)):
+            if key not in root_keys:
+                index_delete_dir(key, changed_inodes)
+        index_restat_inodes(changed_inodes, refreshed_dirs)
+        db_commit()
+
+# return subdirs of dir, listing it again if it changed since it was indexed
+# refreshed_dirs: keys of dirs which were listed again
+def index_refresh_dir(dirpath, parent_key, root_key, scan_start_ns, changed_inodes, refreshed_dirs):
+    key = manifest_dir_key(dirpath)
+    try:
+        dir_stat = os.stat(dirpath)
+        count('stat_calls')
+        if db_read('select dev, mtime_ns from index_dirs where dir=?', (key,)) == (dir_stat.st_dev, dir_stat.st_mtime_ns):
+            return [os.path.join(dirpath, os.path.basename(os.fsdecode(subdir_key)))
+                    for subdir_key, in db_query('select dir from index_dirs where parent=?', (key,))]
+        fd = os.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            files, subdirs, _, _ = list_dir_fd(dirpath, '', fd, False, None)
+        finally:
+            os.close(fd)
+    except OSError:
+        index_delete_dir(key, changed_inodes)
+        return []
+    count('index_dirs_refreshed')
+    refreshed_dirs.add(key)
+    subdirs = [os.path.join(dirpath, name) for name in subdirs]
+    subdir_keys = set(manifest_dir_key(subdir) for subdir in subdirs)
+    for subdir_key, in db_query('select dir from index_dirs where parent=?', (key,)):
+        if subdir_key not in subdir_keys:
+            index_delete_dir(subdir_key, changed_inodes)
+    changed_inodes.update(db_query('select size, dev, ino from index_files where dir=? and nlink > 1', (key,)))
+    db_write('delete from index_files where dir=?', (key,))
+    for name, stat in files:
+        db_write('insert into index_files (dir, name, root, dev, ino, nlink, size) values (?, ?, ?, ?, ?, ?, ?)',
+                 (key, os.fsencode(name), root_key, stat.st_dev, stat.st_ino, stat.st_nlink, stat.st_size))
+        if stat.st_nlink > 1:
+            changed_inodes.add((stat.st_size, stat.st_dev, stat.st_ino))
+    mtime_ns = dir_stat.st_mtime_ns if dir_stat.st_mtime_ns <= scan_start_ns-MANIFEST_MTIME_MARGIN_NS else 0
+    db_write('insert or replace into index_dirs (dir, parent, dev, mtime_ns) values (?, ?, ?, ?)', (key, parent_key, dir_stat.st_dev, mtime_ns))
+    return subdirs
+
+# update hardlink counts of files of changed inodes in dirs which were not listed again
+# file which was replaced without change of mtime of its dir is left to next refresh, which lists its dir again
+def index_restat_inodes(changed_inodes, refreshed_dirs):
+    db_dir = os.path.dirname(os.path.abspath(db_path))
+    for size, dev, ino in changed_inodes:
+        for dir_, name, nlink in db_query('select dir, name, nlink from index_files where size=? and dev=? and ino=?', (size, dev, ino)):
+            if dir_ in refreshed_dirs:
+                continue
+            try:
+                stat = os.stat(os.path.join(db_dir, os.fsdecode(dir_), os.fsdecode(name)), follow_symlinks=False)
+                count('stat_calls')
+            except OSError:
+                stat = None
+            if stat is None or (stat.st_dev, stat.st_ino) != (dev, ino):
+                db_write('update index_dirs set mtime_ns=0 where dir=?', (dir_,))
+            elif stat.st_nlink != nlink:
+                db_write('update index_files set nlink=? where dir=? and name=?', (stat.st_nlink, dir_, name))
+                count('index_nlinks_updated')
+
+# yield (size, nlink, {root keys}, [paths]) for inodes in index with size >= min_size, largest first
+# rows are streamed in order of (size, dev, ino) index, so hardlinks of inode are adjacent
+def iter_index_inodes(min_size):
+    db_dir = os.path.dirname(os.path.abspath(db_path))
+    inode = None
+    for size, dev, ino, nlink, root, dir_, name in db_iter('select size, dev, ino, nlink, root, dir, name from index_files where size >= ? order by size desc, dev desc, ino desc', (min_size,)):
+        if inode is None or inode[0] != (dev, ino):
+            if inode is not None:
+                yield inode[1:]
+            inode = [(dev, ino), size, 0, set(), []]
+        inode[2] = max(inode[2], nlink)
+        inode[3].add(root)
+        inode[4].append(os.path.join(db_dir, os.fsdecode(dir_), os.fsdecode(name)))
+    if inode is not None:
+        yield inode[1:]
+
+# refresh index of workdir and print inodes for which filter_func(nlink, roots, paths) is true, largest first
+# min_size: with k, m, g, t suffix, limit: max number of inodes
+def list_index_files(workdir, min_size, limit, filter_func):
+    open_workdir_db(workdir)
+    if get_db() is None:
+        print(' readonly mode, no index to list files from')
+        return
+    if not CONFIG_READONLY:
+        index_refresh(workdir)
+    else:
+        print(' readonly mode, listing files from index as of last refresh')
+    limit = int(limit) if limit is not None else None
+    found = 0
+    for size, nlink, roots, paths in iter_index_inodes(parse_size(min_size)):
+        if limit is not None and found >= limit:
+            break
+        if not filter_func(nlink, roots, paths):
+            continue
+        found += 1
+        print(size_human(size), paths[0])
+        for path in paths[1:]:
+            print('', path)
+
+@command('list-files-with-hardlink-count-single')
+def list_files_with_hardlink_count_single(workdir='.', min_size='0', limit=None):
+    list_index_files(workdir, min_size, limit, lambda nlink, roots, paths: nlink == 1)
+
+# files which would be freed by deleting backup (or accumulator) they are in: all hardlinks are in it
+@command('list-files-unique')
+def list_files_unique(workdir='.', min_size='0', limit=None):
+    list_index_files(workdir, min_size, limit, lambda nlink, roots, paths: len(roots) == 1 and len(paths) >= nlink)
+
+# files which have hardlinks in several backups or outside of workdir
+@command('list-files-shared')
+def list_files_shared(workdir='.', min_size='0', limit=None):
+    list_index_files(workdir, min_size, limit, lambda nlink, roots, paths: len(roots) > 1 or len(paths) < nlink)
 
 # count size of files which do (not) have hardlinks outside of provided paths
 @command('show-size')
 def show_size(*paths):
-    d_stat = {}
-    d_count = {}
+    # files with single hardlink are unique, so only inodes with multiple hardlinks are tracked
+    # (st_dev, st_ino) -> [count, size, nlink] until all hardlinks are found
+    d_multiple = {}
     size_unoptimized = 0
+    size_unique = 0
+    size_shared = 0
     for path in paths:
         print(path)
-        for root, subdirs, files in os.walk(path):
-            for file_ in files:
-                #if not file_.split('.', -1)[-1].lower() in ['jpg', 'jpeg']:
-                #if not file_.split('.', -1)[-1].lower() in ['mp4', 'mov']:
+        with phase('walk'):
+            for filepath, stat in scan_tree(path, get_rules('show-size')):
+                #if not filepath.split('.', -1)[-1].lower() in ['jpg', 'jpeg']:
+                #if not filepath.split('.', -1)[-1].lower() in ['mp4', 'mov']:
                 #    continue
-                stat = os.stat(os.path.join(root, file_), follow_symlinks=False)
-                d_stat[stat.st_ino] = stat
-                d_count[stat.st_ino] = d_count.get(stat.st_ino, 0)+1
-                #print(os.path.join(root[len(path):], file_))
-                #print(d[stat.st_ino])
                 size_unoptimized += stat.st_size
-    size_unique = 0
-    size_shared = 0
-    for st_ino in d_stat:
-        if d_count[st_ino] == d_stat[st_ino].st_nlink:
-            size_unique += d_stat[st_ino].st_size
-        else:
-            size_shared += d_stat[st_ino].st_size
+                if stat.st_nlink == 1:
+                    size_unique += stat.st_size
+                    continue
+                key = (stat.st_dev, stat.st_ino)
+                inode = d_multiple.get(key)
+                if inode is None:
+                    inode = d_multiple[key] = [0, stat.st_size, stat.st_nlink]
+                inode[0] += 1
+                if inode[0] == inode[2]:
+                    size_unique += inode[1]
+                    del d_multiple[key]
+    for count_, size, nlink in d_multiple.values():
+        size_shared += size
     print('unique:', size_human(size_unique), 'shared:', size_human(size_shared), 'total:', size_human(size_unique+size_shared), 'unoptimized total:', size_human(size_unoptimized), 'saved by optimization:', size_human(size_unoptimized-(size_unique+size_shared)))
 
+# number of sets of backups shown in shared inodes part of space-report
+SPACE_REPORT_TOP = 20
+
+# one scan of all backups (and accumulator) of workdir, attributing every inode to set of backups which have hardlinks to it
+# reclaimable: space which would be freed by deleting backup (or all backups of device-tag or year),
+# i.e. size of inodes which are only referenced by them (inodes with hardlinks outside of workdir are never reclaimable)
+@command('space-report')
+def space_report(workdir='.'):
+    members = list_backups(workdir)
+    if os.path.isdir(os.path.join(workdir, 'accumulator')):
+        members.append('accumulator')
+    # files with single hardlink belong to single backup, so only inodes with multiple hardlinks are tracked
+    # (st_dev << 64 | st_ino) -> row of arrays, mask has bit of every backup which has hardlink to inode
+    rows = {}
+    masks = array('Q') if len(members) <= 64 else []
+    sizes = array('Q')
+    nlinks = array('I')
+    links_found = array('I')
+    # mask -> size of inodes which are referenced only by backups of mask
+    size_by_mask = collections.Counter()
+    size_total = collections.Counter()
+    # every inode is counted once, with extension of first hardlink found
+    size_by_ext = collections.Counter()
+    with phase('walk'):
+        for i, member in enumerate(members):
+            bit = 1 << i
+            for filepath, stat in scan_tree(os.path.join(workdir, member), get_rules('space-report')):
+                size_total[member] += stat.st_size
+                if stat.st_nlink == 1:
+                    size_by_mask[bit] += stat.st_size
+                    size_by_ext[os.path.splitext(filepath)[1].lower()] += stat.st_size
+                    continue
+                key = stat.st_dev << 64 | stat.st_ino
+                row = rows.get(key)
+                if row is None:
+                    row = rows[key] = len(sizes)
+                    masks.append(0)
+                    sizes.append(stat.st_size)
+                    nlinks.append(stat.st_nlink)
+                    links_found.append(0)
+                    size_by_ext[os.path.splitext(filepath)[1].lower()] += stat.st_size
+                masks[row] |= bit
+                links_found[row] += 1
+    size_outside = 0
+    for row in range(len(sizes)):
+        if links_found[row] < nlinks[row]:
+            size_outside += sizes[row]
+        else:
+            size_by_mask[masks[row]] += sizes[row]
+    def reclaimable(group_mask):
+        return sum(size for mask, size in size_by_mask.items() if not mask & ~group_mask)
+    def group_masks(key_func):
+        groups = {}
+        for i, member in enumerate(members):
+            if member != 'accumulator':
+                groups[key_func(member)] = groups.get(key_func(member), 0) | 1 << i
+        return groups
+    print('backups (total, reclaimable by deleting backup):')
+    for i, member in enumerate(members):
+        print('', member, size_human(size_total[member]), size_human(reclaimable(1 << i)))
+    print('device-tags (reclaimable by deleting all backups with device-tag):')
+    for tag, group_mask in sorted(group_masks(lambda backup: backup.split('_')[1]).items()):
+        print('', tag, size_human(reclaimable(group_mask)))
+    print('years (reclaimable by deleting all backups of year):')
+    for year, group_mask in sorted(group_masks(lambda backup: backup[:4]).items()):
+        print('', year, size_human(reclaimable(group_mask)))
+    print('extensions (stored):')
+    for ext, size in size_by_ext.most_common():
+        print('', ext or '(none)', size_human(size))
+    print('shared inodes by set of backups referencing them (top {0}):'.format(SPACE_REPORT_TOP))
+    shared = [(size, mask) for mask, size in size_by_mask.items() if mask & (mask-1)]
+    for size, mask in sorted(shared, reverse=True)[:SPACE_REPORT_TOP]:
+        print('', size_human(size), ', '.join(member for i, member in enumerate(members) if mask >> i & 1))
+    print('stored total:', size_human(sum(size_by_mask.values())+size_outside), 'hardlinked from outside of workdir (never reclaimable):', size_human(size_outside))
+
 # truncate file to 0 (freeing space even if it has hardlink count >1)
 # `echo ''> file`
 # but preserve mtime (stat)
@@ -351,21 +2272,123 @@ def show_size(*paths):
 # `cp -al src dst`
 @command('clone-hardlink')
 def clone_hardlink(src, dst):
-    for root, dirs, files in os.walk(src):
-        rel_path = os.path.join(os.path.relpath(root, src), '')
-        dst_path = os.path.join(dst, rel_path)
-        if not CONFIG_READONLY:
-            os.makedirs(dst_path, exist_ok=True)
-        else:
-            print('readonly, skipping modifying op')
-        for file_ in files:
-            rel_path = os.path.join(os.path.relpath(root, src), file_)
-            src_path = os.path.join(src, rel_path)
-            dst_path = os.path.join(dst, rel_path)
+    if not CONFIG_READONLY:
+        os.makedirs(dst, exist_ok=True)
+    else:
+        print('readonly, skipping modifying op')
+    clone_hardlink_dir(os.open(src, os.O_RDONLY | os.O_DIRECTORY), os.open(dst, os.O_RDONLY | os.O_DIRECTORY) if not CONFIG_READONLY else None, '', get_rules('clone-hardlink'))
+
+# like `cp -al` of dir, with both dirs held open, so that entries are linked and created relative to them
+# src_fd and dst_fd (None in readonly mode) are closed when dir is done
+# rel_dir: path of dir relative to src, entries excluded by rules are not cloned
+def clone_hardlink_dir(src_fd, dst_fd, rel_dir, rules):
+    try:
+        # same as os.walk: dirs which can't be listed are skipped
+        try:
+            with os.scandir(src_fd) as it:
+                entries = list(it)
+        except OSError:
+            return
+        for entry in entries:
+            if rules is not None and rules.excludes_entry(rules_relpath(rel_dir, entry.name), entry):
+                continue
+            # same as os.walk: symlinks to dirs are not followed
+            if entry.is_dir():
+                if entry.is_symlink():
+                    continue
+                try:
+                    subdir_src_fd = os.open(entry.name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=src_fd)
+                except OSError:
+                    continue
+                subdir_dst_fd = None
+                if not CONFIG_READONLY:
+                    try:
+                        os.mkdir(entry.name, dir_fd=dst_fd)
+                    except FileExistsError:
+                        pass
+                    subdir_dst_fd = os.open(entry.name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=dst_fd)
+                else:
+                    print('readonly, skipping modifying op')
+                clone_hardlink_dir(subdir_src_fd, subdir_dst_fd, rules_relpath(rel_dir, entry.name), rules)
+                continue
             if not CONFIG_READONLY:
-                os.link(src_path, dst_path)
+                os.link(entry.name, entry.name, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
             else:
                 print('readonly, skipping modifying op')
+    finally:
+        os.close(src_fd)
+        if dst_fd is not None:
+            os.close(dst_fd)
+
+# dir entries sorted by name, or None if dir can't be listed
+# rel_dir: path of dir relative to root, entries excluded by rules are skipped
+def list_dir_sorted(path, rel_dir='', rules=None):
+    try:
+        with os.scandir(path) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError:
+        return None
+    if rules is not None:
+        entries = [entry for entry in entries if not rules.excludes_entry(rules_relpath(rel_dir, entry.name), entry)]
+    return entries
+
+# dirs are printed with trailing separator
+def rel_entry_path(rel_dir, entry):
+    if entry.is_dir(follow_symlinks=False):
+        return os.path.join(rel_dir, entry.name, '')
+    return os.path.join(rel_dir, entry.name)
+
+# yield (kind, rel_path, src_path, dst_path, src_stat, dst_stat) for entries of src and dst trees
+# trees are walked together as merge-join of sorted dir listings, so that memory is only needed for dirs on current path
+def iter_verify_entries(src, dst, allow_new_files, rules=None):
+    stack = ['.']
+    while stack:
+        rel_dir = stack.pop()
+        rules_rel_dir = rel_dir[2:]
+        src_entries = list_dir_sorted(os.path.join(src, rel_dir), rules_rel_dir, rules) or []
+        dst_entries = list_dir_sorted(os.path.join(dst, rel_dir), rules_rel_dir, rules) or []
+        subdirs = []
+        i = j = 0
+        while i < len(src_entries) or j < len(dst_entries):
+            src_entry = src_entries[i] if i < len(src_entries) else None
+            dst_entry = dst_entries[j] if j < len(dst_entries) else None
+            if dst_entry is None or (src_entry is not None and src_entry.name < dst_entry.name):
+                i += 1
+                yield 'only in src', rel_entry_path(rel_dir, src_entry), None, None, None, None
+                continue
+            if src_entry is None or dst_entry.name < src_entry.name:
+                j += 1
+                if not allow_new_files:
+                    yield 'only in dst', rel_entry_path(rel_dir, dst_entry), None, None, None, None
+                continue
+            i += 1
+            j += 1
+            rel_path = os.path.join(rel_dir, src_entry.name)
+            src_is_dir = src_entry.is_dir(follow_symlinks=False)
+            if src_is_dir != dst_entry.is_dir(follow_symlinks=False):
+                yield 'type mismatch', rel_path, None, None, None, None
+            elif src_is_dir:
+                subdirs.append(rel_path)
+            else:
+                yield 'file', rel_path, src_entry.path, dst_entry.path, src_entry.stat(follow_symlinks=False), dst_entry.stat(follow_symlinks=False)
+        stack.extend(reversed(subdirs))
+
+# return (ok, message) for entry yielded by iter_verify_entries
+def verify_entry(kind, rel_path, src_path, dst_path, src_stat, dst_stat, allow_older_mtimes):
+    if kind != 'file':
+        return False, kind+': '+rel_path
+    if (dst_stat.st_mtime_ns < src_stat.st_mtime_ns and not allow_older_mtimes) or dst_stat.st_mtime_ns > src_stat.st_mtime_ns:
+        return False, 'mtime mismatch: '+rel_path
+    # same inode, nothing to compare
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True, None
+    if S_ISLNK(src_stat.st_mode) or S_ISLNK(dst_stat.st_mode):
+        if not (S_ISLNK(src_stat.st_mode) and S_ISLNK(dst_stat.st_mode) and os.readlink(src_path) == os.readlink(dst_path)):
+            return False, 'different: '+rel_path
+        return True, None
+    if not files_equal(src_path, dst_path, src_stat, dst_stat):
+        return False, 'different: '+rel_path
+    return True, None
 
 # verify that 2 trees are identical
 # `diff -r src dst`
@@ -374,48 +2397,18 @@ def clone_hardlink(src, dst):
 # dst: transformed
 # allow_new_files: allow new files in dst
 # allow_older_mtimes: allow mtimes on files in dst older than in src
+# content checks run in file jobs thread pool, files which are hardlinks of each other are not compared
 @command('verify')
 def verify(src, dst, allow_new_files=False, allow_older_mtimes=False):
     result = True
-    src_paths = []
-    for root, dirs, files in os.walk(src):
-        rel_path = os.path.join(os.path.relpath(root, src), '')
-        src_paths.append(rel_path)
-        dst_path = os.path.join(dst, rel_path)
-        if not os.path.exists(dst_path):
-            print('only in src:', rel_path)
-            result = False
-        for file_ in files:
-            rel_path = os.path.join(os.path.relpath(root, src), file_)
-            src_paths.append(rel_path)
-            src_path = os.path.join(src, rel_path)
-            dst_path = os.path.join(dst, rel_path)
-            if not os.path.exists(dst_path):
-                print('only in src:', rel_path)
-                result = False
-                continue
-            # TODO
-            src_stat = os.stat(src_path, follow_symlinks=False)
-            dst_stat = os.stat(dst_path, follow_symlinks=False)
-            if (dst_stat.st_mtime < src_stat.st_mtime and not allow_older_mtimes) or dst_stat.st_mtime > src_stat.st_mtime:
-                print('mtime mismatch:', rel_path)
-                result = False
-                continue
-            if not filecmp.cmp(src_path, dst_path):
-                print('different:', rel_path)
-                result = False
-    if allow_new_files==True:
-        return result
-    for root, dirs, files in os.walk(dst):
-        rel_path = os.path.join(os.path.relpath(root, dst), '')
-        if rel_path not in src_paths:
-            print('only in dst:', rel_path)
+    allow_new_files = allow_new_files in (True, '1')
+    allow_older_mtimes = allow_older_mtimes in (True, '1')
+    entries = ((*entry, allow_older_mtimes) for entry in iter_verify_entries(src, dst, allow_new_files, get_rules('verify')))
+    for ok, msg in map_jobs(verify_entry, entries):
+        if not ok:
+            print(msg)
             result = False
-        for file_ in files:
-            rel_path = os.path.join(os.path.relpath(root, dst), file_)
-            if rel_path not in src_paths:
-                print('only in dst:', rel_path)
-                result = False
+    db_commit()
     return result
 
 # for any jpeg file, create jpeg-xl, verify that decoded pixmap is identical and metadata is identical, and overwrite original
@@ -424,6 +2417,81 @@ def verify(src, dst, allow_new_files=False, allow_older_mtimes=False):
 # multiple hardlinks, change of filename?
 #@command('convert-to-jxl')
 
+# stat path and check that it still has fingerprint recorded in plan
+def check_fingerprint(path, fingerprint):
+    try:
+        stat = os.stat(path, follow_symlinks=False)
+    except FileNotFoundError:
+        print_to_msg_buf(' does not exist:', path)
+        return None
+    count('stat_calls')
+    if file_fingerprint(stat) != fingerprint:
+        print_to_msg_buf(' changed since plan:', path)
+        return None
+    return stat
+
+# return None if op is already done, False if files changed since plan, True if op was performed
+def apply_plan_op(op):
+    print_to_msg_buf(op['op'], op.get('path') or '{0} {1}'.format(op['src'], op['dst']))
+    if op['op'] == 'mkdir':
+        if os.path.isdir(op['path']):
+            return None
+        os.makedirs(op['path'])
+        return True
+    if op['op'] == 'utime':
+        if os.path.lexists(op['path']) and file_fingerprint(os.stat(op['path'], follow_symlinks=False)) == op['fingerprint'][:3]+[op['mtime_ns']]:
+            return None
+        stat = check_fingerprint(op['path'], op['fingerprint'])
+        if stat is None:
+            return False
+        os.utime(op['path'], ns=(stat.st_atime_ns, op['mtime_ns']))
+        return True
+    src_stat = check_fingerprint(op['src'], op['src_fingerprint'])
+    if src_stat is None:
+        return False
+    if op['op'] == 'link-new':
+        if os.path.lexists(op['dst']):
+            if os.path.samefile(op['src'], op['dst']):
+                return None
+            print_to_msg_buf(' exists:', op['dst'])
+            return False
+        with phase('link'):
+            os.link(op['src'], op['dst'])
+        return True
+    if op['op'] == 'link':
+        if os.path.lexists(op['dst']) and os.path.samefile(op['src'], op['dst']):
+            return None
+        dst_stat = check_fingerprint(op['dst'], op['dst_fingerprint'])
+        if dst_stat is None:
+            return False
+        # hardlink count rules were checked for hardlink count of dst at plan time
+        if dst_stat.st_nlink > op['dst_nlink']:
+            print_to_msg_buf(' dst hardlink count increased since plan')
+            return False
+        replace_with_hardlink(op['src'], op['dst'])
+        count('links_created')
+        if dst_stat.st_nlink == 1:
+            count('link_bytes_saved', dst_stat.st_size)
+        return True
+    print_to_msg_buf(' unknown op')
+    return False
+
+# perform ops of plan written by readonly run with ANTICLOUD_PLAN
+# files are not compared again, ops whose files changed since plan (by dev, ino, size and mtime) are skipped and reported as failed
+@command('apply-plan')
+def apply_plan(plan):
+    result = True
+    if CONFIG_READONLY:
+        print(' readonly mode, skipping modifying op')
+        return result
+    with open(plan) as f:
+        for line in f:
+            res = apply_plan_op(json.loads(line))
+            if res == False:
+                result = False
+            print_msgs_for_result(res, take_msg_buf())
+    return result
+
 # backup using adb only selected brahcnes of tree (DCIM, Download, ...) only after datetime, skip on fail
 #@command('adb')
 
@@ -434,13 +2502,26 @@ def copy_hardlink_range(first, last, dst_dir):
     src_dir = os.path.dirname(first) or '.'
     basename_first = os.path.basename(first)
     basename_last = os.path.basename(last)
-    for item in sorted(os.listdir(src_dir)):
-        if os.path.isfile(os.path.join(src_dir, item)) and basename_first<=item<=basename_last:
-            print(item)
-            if not CONFIG_READONLY:
-                os.link(os.join(src_dir, item), os.join(dst_dir, item))
-            else:
-                print(' readonly mode, skipping modifying op')
+    src_fd = os.open(src_dir, os.O_RDONLY | os.O_DIRECTORY)
+    dst_fd = os.open(dst_dir, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for item in sorted(os.listdir(src_fd)):
+            if not basename_first<=item<=basename_last:
+                continue
+            # same as os.path.isfile
+            try:
+                is_file = S_ISREG(os.stat(item, dir_fd=src_fd).st_mode)
+            except OSError:
+                is_file = False
+            if is_file:
+                print(item)
+                if not CONFIG_READONLY:
+                    os.link(item, item, src_dir_fd=src_fd, dst_dir_fd=dst_fd)
+                else:
+                    print(' readonly mode, skipping modifying op')
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
 
 if __name__ == '__main__':
     if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS:
@@ -451,7 +2532,12 @@ if __name__ == '__main__':
     if not func:
         print('unknown command: ', cmd)
         exit()
+    start = time.perf_counter()
+    # plan is not reset by command which reads it
+    if func is not apply_plan:
+        start_plan()
     result = func(*args)
+    finish_command(cmd, result, start)
     if result==True:
         print('all operations succeeded')
     elif result==False:
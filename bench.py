@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# benchmark of anticloud commands on generated workdirs
+# `python3 bench.py [--save results.json] [--baseline results.json]`
+# every command is run in separate process on freshly generated workdir, so that runs don't affect each other
+# (page cache is not dropped, so file reading is measured warm unless caches are dropped externally)
+import os, sys, json, time, random, shutil, argparse, tempfile, subprocess, datetime
+
+ANTICLOUD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'anticloud.py')
+
+# dirs in which files are placed in generated backups
+BACKUP_SUBDIRS = ['DCIM/Camera', 'DCIM/Screenshots', 'Download', 'WhatsApp/Media/WhatsApp Images']
+
+# generate workdir with yyyy-mm-dd_tag backups
+# each backup is previous backup of same tag with some files added, renamed, replaced with near duplicates (same size, different content)
+# and with rest of files either already hardlinked to previous backup (as if merged earlier) or copied
+def generate_workdir(workdir, args):
+    rnd = random.Random(args.seed)
+    date = datetime.date(2024, 1, 1)
+    os.makedirs(workdir, exist_ok=True)
+    for tag_i in range(args.tags):
+        tag = 'phone{0}'.format(tag_i)
+        # relpath -> (path of file in previous backup, size, mtime)
+        files = {}
+        counter = 0
+        for backup_i in range(args.backups):
+            backup = os.path.join(workdir, '{0}_{1}'.format(date+datetime.timedelta(days=backup_i), tag))
+            prev_files = files
+            files = {}
+            for relpath, (prev_path, size, mtime) in prev_files.items():
+                if rnd.random() < args.rename_ratio:
+                    relpath = os.path.join(os.path.dirname(relpath), 'renamed_'+os.path.basename(relpath))
+                path = os.path.join(backup, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if rnd.random() < args.near_dup_ratio:
+                    data = bytearray(open(prev_path, 'rb').read())
+                    if data:
+                        data[rnd.randrange(len(data))] ^= 0xff
+                    open(path, 'wb').write(data)
+                elif rnd.random() < args.hardlink_ratio:
+                    os.link(prev_path, path)
+                else:
+                    shutil.copyfile(prev_path, path)
+                os.utime(path, ns=(mtime, mtime))
+                files[relpath] = (path, size, mtime)
+            count_new = args.files if backup_i == 0 else int(args.files*args.new_ratio)
+            for i in range(count_new):
+                counter += 1
+                relpath = os.path.join(rnd.choice(BACKUP_SUBDIRS), 'IMG_{0:08d}.jpg'.format(counter))
+                size = min(int(rnd.lognormvariate(0, 1)*args.size), args.size*100)
+                path = os.path.join(backup, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                open(path, 'wb').write(rnd.randbytes(size))
+                mtime = 1700000000*10**9+counter*10**9
+                os.utime(path, ns=(mtime, mtime))
+                files[relpath] = (path, size, mtime)
+    # dirs are made old, so that they are not considered recently modified
+    for root, dirs, files_ in os.walk(workdir):
+        os.utime(root, ns=(1700000000*10**9, 1700000000*10**9))
+
+def count_files(path):
+    return sum(len(files) for root, dirs, files in os.walk(path))
+
+# command name -> function returning (argv, number of files processed) for generated workdir
+def command_merge_hardlink(workdir):
+    backups = sorted(os.listdir(workdir))
+    backups = [b for b in backups if b.endswith(backups[0].split('_')[1])]
+    old, new = os.path.join(workdir, backups[0]), os.path.join(workdir, backups[1])
+    return ['merge-hardlink', old, new], count_files(old)+count_files(new)
+
+def command_workdir(name):
+    def command(workdir):
+        return [name, workdir], count_files(workdir)
+    return command
+
+def command_show_size(workdir):
+    return ['show-size']+[os.path.join(workdir, b) for b in sorted(os.listdir(workdir))], count_files(workdir)
+
+def command_verify(workdir):
+    src = os.path.join(workdir, sorted(os.listdir(workdir))[0])
+    dst = workdir+'-verify-copy'
+    shutil.copytree(src, dst, copy_function=shutil.copy2)
+    return ['verify', src, dst], count_files(src)*2
+
+def command_clone_hardlink(workdir):
+    src = os.path.join(workdir, sorted(os.listdir(workdir))[0])
+    return ['clone-hardlink', src, workdir+'-clone'], count_files(src)
+
+COMMANDS = {
+    'merge-hardlink': command_merge_hardlink,
+    'merge-hardlink-all': command_workdir('merge-hardlink-all'),
+    'accumulate-all': command_workdir('accumulate-all'),
+    'show-size': command_show_size,
+    'space-report': command_workdir('space-report'),
+    'verify': command_verify,
+    'clone-hardlink': command_clone_hardlink,
+}
+
+# run in child process: run anticloud command and write its resource usage to file
+def run_child(result_path, argv):
+    sys.path.insert(0, os.path.dirname(ANTICLOUD))
+    import anticloud, resource
+    cmd, *args = argv
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            result = anticloud.COMMANDS[cmd](*args)
+            anticloud.db_close()
+        finally:
+            sys.stdout = stdout
+    io_ = {}
+    if os.path.exists('/proc/self/io'):
+        for line in open('/proc/self/io'):
+            key, val = line.split(':')
+            io_[key] = int(val)
+    with open(result_path, 'w') as f:
+        json.dump({
+            'result': result,
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+            'read_syscalls': io_.get('syscr'),
+            'write_syscalls': io_.get('syscw'),
+            'bytes_read': anticloud.counters['cmp_bytes_read'],
+        }, f)
+
+# count syscalls of command with strace
+def strace_syscalls(argv, tmpdir):
+    output = os.path.join(tmpdir, 'strace')
+    subprocess.run(['strace', '-f', '-c', '-o', output, sys.executable, ANTICLOUD]+argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for line in open(output):
+        parts = line.split()
+        if parts and parts[-1] == 'total':
+            return int(parts[3] if len(parts) >= 6 else parts[2])
+    return None
+
+def bench_command(name, args):
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        workdir = os.path.join(tmpdir, 'workdir')
+        generate_workdir(workdir, args)
+        argv, count = COMMANDS[name](workdir)
+        if args.strace:
+            # on separate copy of workdir, because command modifies it
+            strace_workdir = os.path.join(tmpdir, 'strace-workdir')
+            generate_workdir(strace_workdir, args)
+            syscalls = strace_syscalls(COMMANDS[name](strace_workdir)[0], tmpdir)
+        result_path = os.path.join(tmpdir, 'result.json')
+        start = time.perf_counter()
+        subprocess.run([sys.executable, __file__, '--run-child', result_path]+argv, check=True)
+        elapsed = time.perf_counter()-start
+        result = json.load(open(result_path))
+    result['seconds'] = elapsed
+    result['files_per_second'] = count/elapsed
+    if args.strace:
+        result['syscalls'] = syscalls
+    return result
+
+METRICS = ['seconds', 'files_per_second', 'bytes_read', 'read_syscalls', 'write_syscalls', 'syscalls', 'peak_rss']
+# metrics for which higher is better, for others lower is better
+METRICS_HIGHER_BETTER = ['files_per_second']
+
+def main():
+    if sys.argv[1:2] == ['--run-child']:
+        run_child(sys.argv[2], sys.argv[3:])
+        return 0
+    parser = argparse.ArgumentParser()
+    parser.add_argument('commands', nargs='*', default=list(COMMANDS), help='commands to benchmark: '+', '.join(COMMANDS))
+    parser.add_argument('--tags', type=int, default=2, help='number of device-tags')
+    parser.add_argument('--backups', type=int, default=5, help='number of backups per device-tag')
+    parser.add_argument('--files', type=int, default=1000, help='number of files in first backup')
+    parser.add_argument('--size', type=int, default=32*1024, help='median file size')
+    parser.add_argument('--new-ratio', type=float, default=0.1, help='files added in each backup, relative to --files')
+    parser.add_argument('--hardlink-ratio', type=float, default=0.5, help='files already hardlinked to previous backup')
+    parser.add_argument('--rename-ratio', type=float, default=0.02, help='files renamed since previous backup')
+    parser.add_argument('--near-dup-ratio', type=float, default=0.01, help='files with same size but different content than in previous backup')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tmpdir', help='dir in which workdirs are generated')
+    parser.add_argument('--strace', action='store_true', help='count all syscalls with strace (runs every command twice)')
+    parser.add_argument('--save', help='save results to json file')
+    parser.add_argument('--baseline', help='compare results with json file saved earlier')
+    parser.add_argument('--threshold', type=float, default=1.2, help='ratio to baseline above which metric is reported as regression')
+    args = parser.parse_args()
+    if args.strace and not shutil.which('strace'):
+        print('strace not found')
+        return 1
+    baseline = json.load(open(args.baseline)) if args.baseline else {}
+    results = {}
+    regressions = 0
+    for name in args.commands:
+        if name not in COMMANDS:
+            print('unknown command:', name)
+            return 1
+        results[name] = result = bench_command(name, args)
+        print(name)
+        for metric in METRICS:
+            if result.get(metric) is None:
+                continue
+            line = ' {0}: {1:.6g}'.format(metric, result[metric])
+            base = baseline.get(name, {}).get(metric)
+            if base:
+                ratio = result[metric]/base if metric not in METRICS_HIGHER_BETTER else base/result[metric] if result[metric] else float('inf')
+                line += ' (baseline {0:.6g}, {1:.2f}x)'.format(base, ratio)
+                if ratio > args.threshold:
+                    line += ' REGRESSION'
+                    regressions += 1
+            print(line)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    exit(main())
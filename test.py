@@ -3,6 +3,11 @@ import unittest
 import tempfile
 import pathlib
 import os
+import json
+import fcntl
+import sqlite3
+import time
+import shutil
 
 FILES = {
     # only in old
@@ -61,3 +66,271 @@ class MyTestCase(unittest.TestCase):
         assert os.path.samefile(old / 'DCIM/20230101_000000.txt', acc / '20230101_000000.txt')
         assert os.path.samefile(old / 'DCIM/20240101_000000.txt', acc / '20240101_000000.txt')
         assert os.path.samefile(new / 'DCIM/20250101_000000.txt', acc / '20250101_000000.txt')
+
+    def test_dedup_global(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        other = self.tmpdir_path / '2025-01-01_bar'
+        os.makedirs(other / 'Download')
+        (other / 'Download/renamed.txt').write_text('20230101_000000')
+        exit_status = os.system("python3 anticloud.py dedup-global {0}".format(self.tmpdir_path))
+        assert exit_status == 0
+        assert os.path.samefile(old / 'DCIM/20230101_000000.txt', new / 'DCIM/20230101_000000.txt')
+        assert os.path.samefile(old / 'DCIM/20230101_000000.txt', other / 'Download/renamed.txt')
+        assert not os.path.samefile(old / 'DCIM/20240101_000000.txt', new / 'DCIM/20240101_000000.txt')
+        assert (new / 'DCIM/20240101_000000.txt').read_text() == '20240101_000000foo'
+
+    def test_verify(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        clone = self.tmpdir_path / 'clone'
+        exit_status = os.system("python3 anticloud.py clone-hardlink {0} {1}".format(old, clone))
+        assert exit_status == 0
+        assert os.path.samefile(old / 'DCIM/20230101_000000.txt', clone / 'DCIM/20230101_000000.txt')
+        exit_status = os.system("python3 anticloud.py verify {0} {1}".format(old, clone))
+        assert exit_status == 0
+        (clone / 'DCIM/20250101_000000.txt').write_text('20250101_000000')
+        exit_status = os.system("python3 anticloud.py verify {0} {1}".format(old, clone))
+        assert exit_status != 0
+        exit_status = os.system("python3 anticloud.py verify {0} {1} 1".format(old, clone))
+        assert exit_status == 0
+
+    def test_apply_plan(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        plan = self.tmpdir_path / 'plan.jsonl'
+        exit_status = os.system("ANTICLOUD_READONLY=1 ANTICLOUD_PLAN={0} python3 anticloud.py merge-hardlink {1} {2}".format(plan, old, new))
+        assert exit_status == 0
+        assert not os.path.samefile(old / 'DCIM/20230101_000000.txt', new / 'DCIM/20230101_000000.txt')
+        exit_status = os.system("python3 anticloud.py apply-plan {0}".format(plan))
+        assert exit_status == 0
+        assert os.path.samefile(old / 'DCIM/20230101_000000.txt', new / 'DCIM/20230101_000000.txt')
+        assert not os.path.samefile(old / 'DCIM/20240101_000000.txt', new / 'DCIM/20240101_000000.txt')
+
+    def test_rules(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        clone = self.tmpdir_path / 'clone'
+        rules = self.tmpdir_path / 'rules'
+        rules.write_text('[clone-hardlink]\nexclude 2022*\n')
+        exit_status = os.system("ANTICLOUD_RULES={0} python3 anticloud.py clone-hardlink {1} {2}".format(rules, old, clone))
+        assert exit_status == 0
+        assert not os.path.exists(clone / 'DCIM/20220101_000000.txt')
+        assert os.path.samefile(old / 'DCIM/20230101_000000.txt', clone / 'DCIM/20230101_000000.txt')
+
+    def test_ingest(self):
+        new = self.tmpdir_path / '2025-01-01_foo'
+        src = self.tmpdir_path / 'src'
+        os.makedirs(src / 'DCIM')
+        (src / 'DCIM/20250101_000000.txt').write_text('20250101_000000')
+        os.utime(src / 'DCIM/20250101_000000.txt', ns=(0, os.stat(new / 'DCIM/20250101_000000.txt').st_mtime_ns))
+        (src / 'DCIM/20260101_000000.txt').write_text('20260101_000000')
+        exit_status = os.system("python3 anticloud.py ingest {0} {1} foo".format(src, self.tmpdir_path))
+        assert exit_status == 0
+        ingested = sorted(self.tmpdir_path.glob('*_foo'))[-1]
+        assert ingested != new
+        assert os.path.samefile(new / 'DCIM/20250101_000000.txt', ingested / 'DCIM/20250101_000000.txt')
+        assert (ingested / 'DCIM/20260101_000000.txt').read_text() == '20260101_000000'
+
+    def test_list_files(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        os.link(old / 'DCIM/20230101_000000.txt', new / 'DCIM/shared.txt')
+        with os.popen("python3 anticloud.py list-files-shared {0}".format(self.tmpdir_path)) as f:
+            output = f.read()
+        assert 'shared.txt' in output
+        assert '20220101_000000.txt' not in output
+        with os.popen("python3 anticloud.py list-files-unique {0}".format(self.tmpdir_path)) as f:
+            output = f.read()
+        assert '20220101_000000.txt' in output
+        assert 'shared.txt' not in output
+
+    def test_merge_chain(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        newest = self.tmpdir_path / '2026-01-01_foo'
+        os.makedirs(newest / 'DCIM')
+        (newest / 'DCIM/20230101_000000.txt').write_text('20230101_000000')
+        # older mtime than in previous backup, refused by default config
+        (newest / 'DCIM/20250101_000000.txt').write_text('20250101_000000')
+        os.utime(newest / 'DCIM/20250101_000000.txt', ns=(0, 0))
+        exit_status = os.system("python3 anticloud.py merge-hardlink-all {0}".format(self.tmpdir_path))
+        assert exit_status == 0
+        assert os.path.samefile(old / 'DCIM/20230101_000000.txt', newest / 'DCIM/20230101_000000.txt')
+        with os.popen("python3 anticloud.py merge-hardlink-all {0}".format(self.tmpdir_path)) as f:
+            output = f.read()
+        assert 'old_backup=2024-01-01_foo new_backup=2025-01-01_foo already merged, skipping' in output
+        assert 'old_backup=2025-01-01_foo new_backup=2026-01-01_foo already merged' not in output
+        assert 'old_backup=2024-01-01_foo new_backup=2026-01-01_foo' not in output
+
+    def test_accumulate_readonly(self):
+        acc = self.tmpdir_path / 'accumulator'
+        exit_status = os.system("ANTICLOUD_READONLY=1 python3 anticloud.py accumulate-all {0}".format(self.tmpdir_path))
+        assert exit_status == 0
+        assert not os.path.exists(acc)
+        assert not os.path.exists(self.tmpdir_path / '.anticloud.sqlite')
+
+    def test_manifest(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        db = self.tmpdir_path / 'db.sqlite'
+        metrics = self.tmpdir_path / 'metrics.jsonl'
+        # dirs modified shortly before scan are not recorded in manifest
+        for dir_ in (old, old / 'DCIM', new, new / 'DCIM'):
+            os.utime(dir_, ns=(1700000000*10**9, 1700000000*10**9))
+        cmd = "ANTICLOUD_DB={0} ANTICLOUD_METRICS={1} python3 anticloud.py merge-hardlink {2} {3}".format(db, metrics, old, new)
+        assert os.system(cmd) == 0
+        assert os.system(cmd) == 0
+        summary = json.loads(metrics.read_text().splitlines()[-1])
+        assert summary['counters']['files_from_manifest'] > 0
+        # dir with changed mtime is scanned again
+        (old / 'DCIM/20260101_000000.txt').write_text('20260101_000000')
+        (new / 'DCIM/20260101_000000.txt').write_text('20260101_000000')
+        os.utime(old / 'DCIM/20260101_000000.txt', ns=(1700000000*10**9, 1700000000*10**9))
+        assert os.system(cmd) == 0
+        assert os.path.samefile(old / 'DCIM/20260101_000000.txt', new / 'DCIM/20260101_000000.txt')
+
+    def test_apply_plan_chain(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        newest = self.tmpdir_path / '2026-01-01_foo'
+        plan = self.tmpdir_path / 'plan.jsonl'
+        os.makedirs(newest / 'DCIM')
+        (newest / 'DCIM/20230101_000000.txt').write_text('20230101_000000')
+        # second device-tag, so that chains are planned by worker processes
+        # file of new backup has older mtime, so utime of file of old backup is planned before it is accumulated
+        old_bar = self.tmpdir_path / '2024-01-01_bar'
+        new_bar = self.tmpdir_path / '2025-01-01_bar'
+        for backup in (old_bar, new_bar):
+            os.makedirs(backup / 'DCIM')
+            (backup / 'DCIM/abar.txt').write_text('abar')
+        os.utime(new_bar / 'DCIM/abar.txt', ns=(0, 0))
+        exit_status = os.system("ANTICLOUD_JOBS=2 ANTICLOUD_DST_MTIME_OLDER=setonsrc ANTICLOUD_READONLY=1 ANTICLOUD_PLAN={0} python3 anticloud-auto.py {1}".format(plan, self.tmpdir_path))
+        assert exit_status == 0
+        exit_status = os.system("python3 anticloud.py apply-plan {0}".format(plan))
+        assert exit_status == 0
+        assert os.path.samefile(old / 'DCIM/20230101_000000.txt', newest / 'DCIM/20230101_000000.txt')
+        assert os.path.samefile(old / 'DCIM/20230101_000000.txt', self.tmpdir_path / 'accumulator/20230101_000000.txt')
+        assert os.path.samefile(old_bar / 'DCIM/abar.txt', new_bar / 'DCIM/abar.txt')
+        assert os.path.samefile(old_bar / 'DCIM/abar.txt', self.tmpdir_path / 'accumulator/abar.txt')
+
+    def test_journal_recovery(self):
+        new = self.tmpdir_path / '2025-01-01_foo'
+        tmp = new / 'DCIM/20230101_000000.txt-anticloud-hardlink-tmp'
+        tmp.write_text('20230101_000000')
+        journal = self.tmpdir_path / '.anticloud-journal-999999'
+        journal.write_text(json.dumps({'tmp': str(tmp), 'dst': str(new / 'DCIM/20230101_000000.txt')})+'\n')
+        # journal of running process is not recovered
+        running = self.tmpdir_path / '.anticloud-journal-999998'
+        with open(running, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # second device-tag, so that chains are merged by worker processes
+            for backup in ('2024-01-01_bar', '2025-01-01_bar'):
+                os.makedirs(self.tmpdir_path / backup / 'DCIM')
+                (self.tmpdir_path / backup / 'DCIM/20230101_000000.txt').write_text('20230101_000000')
+            exit_status = os.system("ANTICLOUD_JOBS=2 python3 anticloud.py merge-hardlink-all {0}".format(self.tmpdir_path))
+            assert exit_status == 0
+            assert not os.path.exists(tmp)
+            assert os.path.exists(running)
+            assert sorted(path.name for path in self.tmpdir_path.glob('.anticloud-journal-*')) == [running.name]
+        assert os.path.samefile(self.tmpdir_path / '2024-01-01_bar/DCIM/20230101_000000.txt', self.tmpdir_path / '2025-01-01_bar/DCIM/20230101_000000.txt')
+
+    def test_checkpoint_resume(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        db = self.tmpdir_path / '.anticloud.sqlite'
+        # creates db
+        exit_status = os.system("python3 anticloud.py list-files-shared {0}".format(self.tmpdir_path))
+        assert exit_status == 0
+        conn = sqlite3.connect(db)
+        conn.execute('insert into checkpoints (old_backup, new_backup, path) values (?, ?, ?)', (b'2024-01-01_foo', b'2025-01-01_foo', b'DCIM/20230101_000000.txt'))
+        conn.commit()
+        conn.close()
+        with os.popen("python3 anticloud.py merge-hardlink-all {0}".format(self.tmpdir_path)) as f:
+            output = f.read()
+        assert 'resuming interrupted run after /DCIM/20230101_000000.txt' in output
+        # files up to checkpoint were done by interrupted run
+        assert not os.path.samefile(old / 'DCIM/20230101_000000.txt', new / 'DCIM/20230101_000000.txt')
+        conn = sqlite3.connect(db)
+        assert conn.execute('select count(*) from checkpoints').fetchone()[0] == 0
+        conn.close()
+
+    def test_space_report(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        os.unlink(new / 'DCIM/20230101_000000.txt')
+        os.link(old / 'DCIM/20230101_000000.txt', new / 'DCIM/20230101_000000.txt')
+        with os.popen("python3 anticloud.py space-report {0}".format(self.tmpdir_path)) as f:
+            lines = f.read().splitlines()
+        # shared file (15 bytes) is not reclaimable by deleting either backup
+        assert ' 2024-01-01_foo 45.0b 30.0b' in lines
+        assert ' 2025-01-01_foo 48.0b 33.0b' in lines
+        assert ' foo 78.0b' in lines
+
+    def test_ingest_interrupted(self):
+        src = self.tmpdir_path / 'src'
+        os.makedirs(src / 'DCIM')
+        (src / 'DCIM/20260101_000000.txt').write_text('20260101_000000')
+        # left by interrupted ingest
+        tmp_root = self.tmpdir_path / ('.anticloud-ingest-'+time.strftime('%Y-%m-%d')+'_foo')
+        os.makedirs(tmp_root / 'DCIM')
+        exit_status = os.system("python3 anticloud.py ingest {0} {1} foo".format(src, self.tmpdir_path))
+        assert exit_status == 0
+        assert not os.path.exists(tmp_root)
+        ingested = sorted(self.tmpdir_path.glob('*_foo'))[-1]
+        assert (ingested / 'DCIM/20260101_000000.txt').read_text() == '20260101_000000'
+
+    def test_list_files_after_delete(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        os.unlink(new / 'DCIM/20230101_000000.txt')
+        os.link(old / 'DCIM/20230101_000000.txt', new / 'DCIM/20230101_000000.txt')
+        # dirs modified shortly before refresh would be listed again anyway
+        for dir_ in (old, old / 'DCIM', new, new / 'DCIM'):
+            os.utime(dir_, ns=(1700000000*10**9, 1700000000*10**9))
+        with os.popen("python3 anticloud.py list-files-shared {0}".format(self.tmpdir_path)) as f:
+            assert str(new / 'DCIM/20230101_000000.txt') in f.read()
+        shutil.rmtree(old)
+        with os.popen("python3 anticloud.py list-files-shared {0}".format(self.tmpdir_path)) as f:
+            assert '20230101_000000.txt' not in f.read()
+        with os.popen("python3 anticloud.py list-files-unique {0}".format(self.tmpdir_path)) as f:
+            assert str(new / 'DCIM/20230101_000000.txt') in f.read()
+        with os.popen("python3 anticloud.py list-files-with-hardlink-count-single {0}".format(self.tmpdir_path)) as f:
+            assert str(new / 'DCIM/20230101_000000.txt') in f.read()
+
+    def test_compare_same_size(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        data = bytes(range(256))*(5*1024*1024//256)
+        cases = {
+            # small, read in full
+            'small.txt': (b'20230101_000000', b'20230101_000001'),
+            # large, samples are equal, difference is found when read in full
+            'middle.mp4': (data, data[:5000]+b'x'+data[5001:]),
+            # large, rejected by samples
+            'last.mp4': (data, data[:-1]+b'x'),
+            'equal.mp4': (data, data),
+        }
+        for name, (old_data, new_data) in cases.items():
+            (old / 'DCIM' / name).write_bytes(old_data)
+        for name, (old_data, new_data) in cases.items():
+            (new / 'DCIM' / name).write_bytes(new_data)
+        exit_status = os.system("python3 anticloud.py merge-hardlink {0} {1}".format(old, new))
+        assert exit_status == 0
+        for name in ('small.txt', 'middle.mp4', 'last.mp4'):
+            assert not os.path.samefile(old / 'DCIM' / name, new / 'DCIM' / name)
+        assert os.path.samefile(old / 'DCIM/equal.mp4', new / 'DCIM/equal.mp4')
+
+    def test_manifest_recent_subdir(self):
+        old = self.tmpdir_path / '2024-01-01_foo'
+        new = self.tmpdir_path / '2025-01-01_foo'
+        db = self.tmpdir_path / 'db.sqlite'
+        os.makedirs(old / 'DCIM/Camera')
+        os.makedirs(new / 'DCIM/Camera')
+        # parent dirs are old, but Camera is modified shortly before scan, so it is not recorded in manifest
+        for dir_ in (old, old / 'DCIM', new, new / 'DCIM'):
+            os.utime(dir_, ns=(1700000000*10**9, 1700000000*10**9))
+        cmd = "ANTICLOUD_DB={0} python3 anticloud.py merge-hardlink {1} {2}".format(db, old, new)
+        assert os.system(cmd) == 0
+        assert os.system(cmd) == 0
+        (old / 'DCIM/Camera/c.jpg').write_text('c')
+        (new / 'DCIM/Camera/c.jpg').write_text('c')
+        os.utime(old / 'DCIM/Camera/c.jpg', ns=(1700000000*10**9, 1700000000*10**9))
+        assert os.system(cmd) == 0
+        assert os.path.samefile(old / 'DCIM/Camera/c.jpg', new / 'DCIM/Camera/c.jpg')